@@ -15,15 +15,32 @@ import os
 import sys
 import numpy as np
 import json
+from bisect import bisect_right
 from nptdms import TdmsFile
 from scipy.signal import savgol_filter, butter, filtfilt
 from moviepy import VideoFileClip
 import math
 
+# Import local modules
+from image_stacks import is_image_stack, ImageStack, ImageStackCapture
+
 # Get the path of the application
 # This is important for when using executable files
 APPLICATION_PATH = os.path.abspath(".")
 
+# When reading a frame this many (or fewer) frames ahead of the current position,
+# frames are skipped by decoding forward rather than by seeking
+MAX_SEQUENTIAL_SKIP = 15
+
+# Extension added to a video's file name for its seek index sidecar file
+SEEK_INDEX_EXTENSION = '.pdaidx'
+
+# Extension added to a video's file name for its low resolution proxy video (and its key)
+PROXY_EXTENSION = '.pdaproxy.avi'
+PROXY_KEY_EXTENSION = '.pdaproxy.json'
+# Largest width or height (pixels) of a proxy video's frames
+PROXY_MAX_SIZE = 320
+
 def resource_path(relative_path):
     plat = platform()
     if 'mac' in plat:
@@ -115,8 +132,8 @@ def generate_y_axis_labels(min_value, max_value, num_labels):
     labels = [str(label).rstrip('0').rstrip('.') if '.' in str(label) else str(label) for label in labels]
     return labels
 
-def count_frames(video_loc):
-    """Accurately finds the number of frames in the video.
+def probe_frame_count(video_loc):
+    """Finds the number of frames in the video by seeking and decoding frames (slow).
     - assumes the video can be read"""
     # Read file using cv2
     cap = cv2.VideoCapture(video_loc)
@@ -257,14 +274,20 @@ def file_date(file_loc):
         date = "File not found."
     return date
 
-def is_video_file(file_loc):
-    """Checks if the file has a correct extension and is readable."""
+def has_video_extension(file_loc):
+    """Checks if the file has a correct extension for a video (without opening it)."""
     # Extract the file extension
     file_extension = os.path.splitext(file_loc)[1].lower()
     # List of common video file extensions
     video_extensions = ['.mp4', '.avi', '.mkv', '.mov', '.wmv', '.flv']
     # If the file extension is in the list of video extensions
-    if file_extension in video_extensions:
+    return file_extension in video_extensions
+
+def is_video_file(file_loc):
+    """Checks if the file has a correct extension and is readable.
+    - image stacks (see image_stacks.py) are read like videos, so they count too"""
+    # If the file extension is in the list of video extensions (or it is an image stack)
+    if has_video_extension(file_loc) or is_image_stack(file_loc):
         # Try open and read file
         try:
             # Read file into TdmsFile object
@@ -318,8 +341,8 @@ def is_ion_file(file_loc):
         return False
 
 def read_vid(video_loc):
-    # Open the video file
-    cap = cv2.VideoCapture(video_loc)
+    # Open the video file (or image stack)
+    cap = open_capture(video_loc)
     # Check if the video file is opened successfully
     if not cap.isOpened():
         print("Error: Could not open video file.")
@@ -332,10 +355,50 @@ def read_vid(video_loc):
         return None
     return cap
 
-def get_frame(cap, target_frame):
+def open_capture(video_loc, image_stack=None):
+    """Opens a video file, or an image stack (see image_stacks.py), as a VideoCapture.
+    - an image stack that is already open can be given, so it is shared rather than read again"""
+    if image_stack is not None:
+        return ImageStackCapture(image_stack)
+    if is_image_stack(video_loc):
+        return ImageStackCapture(ImageStack(video_loc))
+    return cv2.VideoCapture(video_loc)
+
+def seek_to_frame(cap, target_frame, seek_index=None):
+    """Positions the video (cap) so that the next read is the target frame.
+    - seeking decodes forward from the previous keyframe, so it is often slower than stepping forward
+    - with a seek index (see build_seek_index) it only seeks if there is a keyframe between
+      the current position and the target, and then it seeks to that keyframe
+    - without one, it steps forward if the target is a few frames ahead, otherwise it seeks"""
+    # Get the position of the next frame to be read
+    position = int(cap.get(cv2.CAP_PROP_POS_FRAMES))
+    if seek_index is not None and seek_index.get('keyframes'):
+        # Find the last keyframe at or before the target
+        keyframes = seek_index['keyframes']
+        i = bisect_right(keyframes, target_frame) - 1
+        keyframe = keyframes[i] if i >= 0 else 0
+        # If decoding forward from here won't pass that keyframe, just step forward
+        if keyframe <= position <= target_frame:
+            start_frame = position
+        else:
+            # Jump to the keyframe, then step forward
+            cap.set(cv2.CAP_PROP_POS_FRAMES, keyframe)
+            start_frame = keyframe
+    # If the target is just ahead of the current position
+    elif 0 <= target_frame - position <= MAX_SEQUENTIAL_SKIP:
+        start_frame = position
+    else:
+        # Set the video capture object to the target frame
+        cap.set(cv2.CAP_PROP_POS_FRAMES, target_frame)
+        start_frame = target_frame
+    # Step forward, grabbing (but not retrieving) the frames in between
+    for _ in range(target_frame - start_frame):
+        cap.grab()
+
+def get_frame(cap, target_frame, seek_index=None):
     """Returns the specified frame in the video (cap)."""
     # Set the video capture object to the target frame
-    cap.set(cv2.CAP_PROP_POS_FRAMES, target_frame)
+    seek_to_frame(cap, target_frame, seek_index=seek_index)
     # Read the frame from the video
     ret, frame = cap.read()
     # Check if the frame is read successfully
@@ -344,6 +407,199 @@ def get_frame(cap, target_frame):
         return None
     return frame
 
+def iter_frame_range(cap, first_frame, last_frame, seek_index=None):
+    """Yields the frames from first_frame to last_frame (inclusive) in the video (cap).
+    - seeks once and then decodes sequentially, instead of seeking for every frame
+    - frames which cannot be read are None (same as get_frame)"""
+    # Seek once to the first frame
+    seek_to_frame(cap, first_frame, seek_index=seek_index)
+    for frame_num in range(first_frame, last_frame + 1):
+        # Read the next frame from the video
+        ret, frame = cap.read()
+        # If the sequential read failed, try again by seeking to this frame
+        if not ret:
+            frame = get_frame(cap, frame_num, seek_index=seek_index)
+        yield frame
+
+def read_frame_range(cap, first_frame, last_frame, seek_index=None):
+    """Returns a list of the frames from first_frame to last_frame (inclusive) in the video (cap)."""
+    return list(iter_frame_range(cap, first_frame, last_frame, seek_index=seek_index))
+
+def build_seek_index(video_loc):
+    """Makes an index of the video's keyframes, and saves it in a sidecar file.
+    - one pass over the video's packets which doesn't decode any frames (FFmpeg backend only)
+    - the index is a dictionary with 'video' (see file_identity), 'numFrames' and 'keyframes' (frame positions)
+    - returns None if the video cannot be indexed"""
+    # Only possible if this version of OpenCV can report keyframes
+    has_key_frame_prop = getattr(cv2, 'CAP_PROP_LRF_HAS_KEY_FRAME', None)
+    if has_key_frame_prop is None:
+        return None
+    cap = cv2.VideoCapture(video_loc, cv2.CAP_FFMPEG)
+    # Read raw packets rather than decoding frames
+    if not cap.isOpened() or not cap.set(cv2.CAP_PROP_FORMAT, -1):
+        cap.release()
+        return None
+    keyframes, num_frames = [], 0
+    # For every packet (frame) in the video
+    while cap.grab():
+        # If it is a keyframe, keep its position
+        if cap.get(has_key_frame_prop):
+            keyframes.append(num_frames)
+        num_frames += 1
+    cap.release()
+    # If it didn't work
+    if not keyframes:
+        return None
+    seek_index = {
+        'video' : file_identity(video_loc),
+        'numFrames' : num_frames,
+        'keyframes' : keyframes,
+    }
+    # Save it for next time (not a problem if we can't)
+    try:
+        with open(video_loc + SEEK_INDEX_EXTENSION, 'w') as index_file:
+            json.dump(seek_index, index_file)
+    except OSError as e:
+        print(f"Failed to write seek index: {e}")
+    return seek_index
+
+def load_seek_index(video_loc):
+    """Loads the video's seek index from its sidecar file.
+    - returns None if there is none, or if the video has changed since it was made"""
+    try:
+        with open(video_loc + SEEK_INDEX_EXTENSION, 'r') as index_file:
+            seek_index = json.load(index_file)
+        # Check it is for this version of the video
+        if seek_index['video'] != file_identity(video_loc):
+            return None
+        return seek_index
+    except (OSError, ValueError, KeyError):
+        return None
+
+def file_identity(file_loc):
+    """Returns a dictionary which identifies the current version of a file.
+    - if the file is changed or replaced, the size or modification time will differ"""
+    stat = os.stat(file_loc)
+    return {'path': os.path.abspath(file_loc), 'size': stat.st_size, 'modified': stat.st_mtime}
+
+def load_frame_cache(cache_loc, key):
+    """Opens a frame cache (.npy file) as a read-only memory-mapped array of shape (N, H, W, C).
+    - the key (dict) must match the one it was written with, otherwise it is stale
+    - returns None if there is no usable cache"""
+    key_loc = os.path.splitext(cache_loc)[0] + '.json'
+    try:
+        # Check the cache was made for the same video and frames
+        with open(key_loc, 'r') as key_file:
+            if json.load(key_file) != key:
+                print(f"Frame cache is stale: {cache_loc}")
+                return None
+        # Map the file into memory (no frames are actually read yet)
+        return np.load(cache_loc, mmap_mode='r')
+    except (OSError, ValueError):
+        return None
+
+def write_frame_cache(cap, first_frame, last_frame, shape, cache_loc, key, seek_index=None):
+    """Decodes the frames from first_frame to last_frame (inclusive) into a frame cache (.npy file).
+    - frames are written one at a time, so they are never all in memory
+    - frames which cannot be read are left blank (white)
+    - returns the cache as a read-only memory-mapped array, or None if it could not be written"""
+    key_loc = os.path.splitext(cache_loc)[0] + '.json'
+    try:
+        # Remove the old key first, so a half written cache is never used
+        if os.path.exists(key_loc):
+            os.remove(key_loc)
+        # Make the file and write each frame into it
+        num_frames = last_frame - first_frame + 1
+        frames = np.lib.format.open_memmap(cache_loc, mode='w+', dtype=np.uint8, shape=(num_frames,) + tuple(shape))
+        for i, frame in enumerate(iter_frame_range(cap, first_frame, last_frame, seek_index=seek_index)):
+            frames[i] = 255 if frame is None else frame
+        frames.flush()
+        del frames
+        # Write the key now that the cache is complete
+        with open(key_loc, 'w') as key_file:
+            json.dump(key, key_file, indent=2)
+    except (OSError, ValueError) as e:
+        print(f"Failed to write frame cache: {e}")
+        return None
+    return load_frame_cache(cache_loc, key)
+
+def proxy_key(video_loc, num_frames):
+    """Returns the key (dict) identifying the proxy video of this version of the video."""
+    return {'video': file_identity(video_loc), 'numFrames': num_frames, 'maxSize': PROXY_MAX_SIZE}
+
+def load_proxy(video_loc, num_frames):
+    """Opens the video's low resolution proxy video (see write_proxy).
+    - returns None if there is none, or if it was made for a different version of the video"""
+    try:
+        # Check the proxy was made for this version of the video
+        with open(video_loc + PROXY_KEY_EXTENSION, 'r') as key_file:
+            if json.load(key_file) != proxy_key(video_loc, num_frames):
+                return None
+    except (OSError, ValueError):
+        return None
+    cap = cv2.VideoCapture(video_loc + PROXY_EXTENSION)
+    if not cap.isOpened():
+        cap.release()
+        return None
+    return cap
+
+def write_proxy(video_loc, num_frames, seek_index=None, should_stop=None):
+    """Makes a low resolution proxy of the video, for navigating it quickly, and saves it next to the video.
+    - every frame is a JPEG (MJPG) so any frame can be read without decoding its neighbours
+    - frames are downscaled so neither side is larger than PROXY_MAX_SIZE
+    - frames which cannot be read are left blank (white) so frame numbers still line up
+    - should_stop() is checked between frames, if it returns True the proxy is abandoned
+    - returns True if the proxy was written"""
+    proxy_loc = video_loc + PROXY_EXTENSION
+    key_loc = video_loc + PROXY_KEY_EXTENSION
+    # Written to a temporary file first so a half written proxy is never used
+    temp_loc = video_loc + '.tmp' + PROXY_EXTENSION
+    cap = cv2.VideoCapture(video_loc)
+    writer = None
+    try:
+        # Remove the old key first
+        if os.path.exists(key_loc):
+            os.remove(key_loc)
+        # Get the size of the proxy frames (keeping the aspect ratio)
+        ret, frame = cap.read()
+        if not ret:
+            return False
+        height, width = frame.shape[:2]
+        scale = min(1.0, PROXY_MAX_SIZE / max(height, width))
+        proxy_size = (max(1, int(width * scale)), max(1, int(height * scale)))
+        fps = cap.get(cv2.CAP_PROP_FPS) or 30
+        writer = cv2.VideoWriter(temp_loc, cv2.VideoWriter_fourcc(*'MJPG'), fps, proxy_size)
+        if not writer.isOpened():
+            print("Failed to write proxy video: could not open video writer.")
+            return False
+        # Downscale and write every frame
+        for frame in iter_frame_range(cap, 0, num_frames - 1, seek_index=seek_index):
+            if should_stop is not None and should_stop():
+                return False
+            if frame is None:
+                frame = np.ones((height, width, 3), dtype=np.uint8) * 255
+            writer.write(cv2.resize(frame, proxy_size, interpolation=cv2.INTER_AREA))
+        writer.release()
+        writer = None
+        # Replace any old proxy, then write the key now that the proxy is complete
+        os.replace(temp_loc, proxy_loc)
+        with open(key_loc, 'w') as key_file:
+            json.dump(proxy_key(video_loc, num_frames), key_file, indent=2)
+        return True
+    except (OSError, cv2.error) as e:
+        print(f"Failed to write proxy video: {e}")
+        return False
+    finally:
+        cap.release()
+        if writer is not None:
+            writer.release()
+        # Clean up if we didn't finish
+        if os.path.exists(temp_loc):
+            try:
+                os.remove(temp_loc)
+            except OSError:
+                pass
+
 def read_tdms(file_loc):
     """Starter function to read a TDMS file.
     returns basic info and data."""
@@ -535,6 +791,8 @@ def write_experiment_json(experiment, use_ion=True, overwrite_ok=False):
     # Construct dictionary
     # The video filename may differ from experiment.name if the user renamed the experiment
     video_file_name = os.path.splitext(os.path.basename(experiment.vid_loc))[0]
+    # Identifies this version of the video file (so numFrames can be trusted when reloading)
+    vid_identity = file_identity(experiment.vid_loc)
     data_dict = {
         'timestamp' : datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
         'name' : experiment.name,
@@ -545,6 +803,8 @@ def write_experiment_json(experiment, use_ion=True, overwrite_ok=False):
         'videoWidth' : experiment.shape[1],
         'numFrames' : experiment.num_frames,
         'videoDate' : experiment.vid_date,
+        'videoSize' : vid_identity['size'],
+        'videoModified' : vid_identity['modified'],
         'ionCurrentFile' : experiment.ion_loc if use_ion else None,
         'ionDate' : experiment.ion_date if use_ion else None,
         'ionDataLength' : experiment.ioncurr_len if use_ion else None,
@@ -592,7 +852,14 @@ def load_experiment_json(json_file_loc):
     if is_video_file(vid_loc):
         # Create Experiment object
         from jobs import Experiment # This prevents a circular import
-        experiment = Experiment(vid_loc)
+        # If the video is unchanged since the JSON was written, trust its number of frames
+        # (older JSON files don't record the video's size and date, trust those too, so no frames are counted here)
+        vid_identity = file_identity(vid_loc)
+        vid_unchanged = ('videoSize' not in data_dict or 'videoModified' not in data_dict 
+                         or (data_dict['videoSize'] == vid_identity['size'] 
+                             and data_dict['videoModified'] == vid_identity['modified']))
+        num_frames = data_dict['numFrames'] if vid_unchanged else None
+        experiment = Experiment(vid_loc, num_frames=num_frames)
 
         # Restore user-chosen name (may differ from video filename)
         experiment.name = name
@@ -0,0 +1,437 @@
+"""
+Module:  All classes related to reading and caching video frames
+Program: Particle Deformation Analysis
+Author: Haig Bishop (haig.bishop@pg.canterbury.ac.nz)
+"""
+
+# Import modules
+from collections import OrderedDict
+from contextlib import contextmanager
+import threading
+import time
+import cv2
+import numpy as np
+
+# Import local modules
+from file_management import get_frame, read_frame_range, open_capture, load_proxy, write_proxy, downsample_image, MAX_SEQUENTIAL_SKIP
+from image_stacks import is_image_stack, ImageStack
+
+# Number of idle VideoCapture handles kept open for each video
+CAPTURE_POOL_SIZE = 3
+# Number of frames the prefetcher decodes ahead of the requested frame
+PREFETCH_COUNT = 12
+# How often (per second) the UI is expected to ask for a new frame while scrubbing
+PREFETCH_UI_RATE = 60
+# Maximum number of proxy videos being made at the same time
+PROXY_BUILD_SLOTS = threading.BoundedSemaphore(2)
+
+
+class CapturePool():
+    """Pool of VideoCapture handles for one video, so each reader has its own read position.
+    - readers check a handle out, read from it, then return it (use: with pool.checkout(frame) as cap:)
+    - checkout prefers an idle handle positioned just before the frame it will read, so it needn't seek
+    - if every handle is busy a new one is opened, at most CAPTURE_POOL_SIZE idle handles are kept
+    - safe to share between threads (a handle is only used by one reader at a time)
+    - image stacks (see image_stacks.py) are read once and shared by all of the handles
+    - call close() when the video is no longer needed (handles still checked out are closed when returned)"""
+
+    def __init__(self, vid_loc, max_idle=CAPTURE_POOL_SIZE):
+        self.vid_loc = vid_loc
+        self.max_idle = max_idle
+        # The image stack, if it is one rather than a video
+        self.image_stack = ImageStack(vid_loc) if is_image_stack(vid_loc) else None
+        # Handles not checked out (least recently returned first)
+        self.idle = []
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def acquire(self, frame=None):
+        """Checks out a handle (preferably one positioned at or a little before the frame, 0-based)."""
+        with self.lock:
+            if self.idle:
+                # Default to the most recently returned handle
+                best_i, best_distance = len(self.idle) - 1, None
+                if frame is not None:
+                    # Find the handle closest to (but not past) the frame
+                    for i, cap in enumerate(self.idle):
+                        distance = frame - int(cap.get(cv2.CAP_PROP_POS_FRAMES))
+                        if 0 <= distance <= MAX_SEQUENTIAL_SKIP and (best_distance is None or distance < best_distance):
+                            best_i, best_distance = i, distance
+                return self.idle.pop(best_i)
+        # None are idle, open a new one
+        cap = open_capture(self.vid_loc, image_stack=self.image_stack)
+        if not cap.isOpened():
+            cap.release()
+            raise IOError("Could not open video: " + self.vid_loc)
+        return cap
+
+    def release(self, cap):
+        """Returns a checked out handle to the pool (closing it if the pool is full)."""
+        with self.lock:
+            if not self.closed and len(self.idle) < self.max_idle:
+                self.idle.append(cap)
+                return
+        cap.release()
+
+    def close(self):
+        """Closes every idle handle, and any still checked out once they are returned."""
+        with self.lock:
+            self.closed = True
+            idle, self.idle = self.idle, []
+        for cap in idle:
+            cap.release()
+
+    @contextmanager
+    def checkout(self, frame=None):
+        """Context manager which checks out a handle and returns it when done."""
+        cap = self.acquire(frame)
+        try:
+            yield cap
+        finally:
+            self.release(cap)
+
+
+class FrameCache():
+    """Least recently used cache of decoded video frames.
+    - frames are keyed by frame number
+    - holds at most max_mb megabytes of frames, the least recently used are evicted first
+    - cached frames are read-only, copy them before drawing on them
+    - safe to share between threads"""
+
+    def __init__(self, max_mb):
+        # The memory budget in bytes
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.num_bytes = 0
+        # Frames in order of use (least recent first)
+        self.frames = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __contains__(self, frame_num):
+        with self.lock:
+            return frame_num in self.frames
+
+    def __len__(self):
+        with self.lock:
+            return len(self.frames)
+
+    def get(self, frame_num):
+        """Returns the cached frame or None if it is not cached."""
+        with self.lock:
+            frame = self.frames.get(frame_num)
+            # If it was cached
+            if frame is not None:
+                # It is now the most recently used
+                self.frames.move_to_end(frame_num)
+            return frame
+
+    def put(self, frame_num, frame):
+        """Adds a frame to the cache, evicting old frames to stay within budget."""
+        # Never cache a frame which could not fit
+        if frame is None or frame.nbytes > self.max_bytes:
+            return
+        # Stop callers drawing on the shared frame
+        frame.flags.writeable = False
+        with self.lock:
+            # If replacing a frame, forget the old one
+            if frame_num in self.frames:
+                self.num_bytes -= self.frames.pop(frame_num).nbytes
+            self.frames[frame_num] = frame
+            self.num_bytes += frame.nbytes
+            # Evict the least recently used frames until within budget
+            while self.num_bytes > self.max_bytes:
+                _, old_frame = self.frames.popitem(last=False)
+                self.num_bytes -= old_frame.nbytes
+
+    def clear(self):
+        """Removes all frames from the cache."""
+        with self.lock:
+            self.frames.clear()
+            self.num_bytes = 0
+
+
+class FramePrefetcher():
+    """Background thread which decodes frames ahead of the user while they scrub through a video.
+    - it checks out its own VideoCapture from the pool, so it never moves the position of anyone else's
+    - it tracks the direction and speed of requests, and decodes the frames the user will reach next
+    - decoded frames are put in the frame cache, a request's on_frame_ready(frame_num, frame) is called
+      (from the prefetch thread) once the requested frame is decoded (frame is None if it couldn't be)
+    - a new request cancels the frames still waiting to be decoded for older requests"""
+
+    def __init__(self, captures, frame_cache, num_frames, seek_index=None):
+        # The video (held until stopped) and where decoded frames go
+        self.captures = captures
+        self.cap = captures.acquire()
+        self.seek_index = seek_index
+        self.frame_cache = frame_cache
+        self.num_frames = num_frames
+        # The latest request (frame number, callback) and a count of requests so old ones can be cancelled
+        self.condition = threading.Condition()
+        self.target = None
+        self.generation = 0
+        self.stopped = False
+        # Scrubbing velocity in frames per second (+ve is forwards)
+        self.velocity = 0.0
+        self.last_request = None
+        # Start the thread
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def request(self, frame_num, on_frame_ready=None):
+        """Asks for the frame (and the frames after it in the direction of scrubbing) to be decoded."""
+        now = time.monotonic()
+        with self.condition:
+            # Update the scrubbing velocity (smoothed)
+            if self.last_request is not None:
+                last_frame_num, last_time = self.last_request
+                elapsed = max(now - last_time, 1e-3)
+                self.velocity = 0.5 * self.velocity + 0.5 * (frame_num - last_frame_num) / elapsed
+            self.last_request = (frame_num, now)
+            # Replace any older request
+            self.target = (frame_num, on_frame_ready)
+            self.generation += 1
+            self.condition.notify()
+
+    def prefetch_order(self, frame_num, velocity):
+        """Returns the frame numbers to decode for a request, most urgent first.
+        - the requested frame, then the frames the UI is expected to ask for next"""
+        # Direction and number of frames between UI updates at this velocity
+        direction = -1 if velocity < 0 else 1
+        step = max(1, int(round(abs(velocity) / PREFETCH_UI_RATE)))
+        frame_nums = [frame_num]
+        for i in range(1, PREFETCH_COUNT + 1):
+            next_frame_num = frame_num + direction * step * i
+            if not 1 <= next_frame_num <= self.num_frames:
+                break
+            frame_nums.append(next_frame_num)
+        return frame_nums
+
+    def run(self):
+        """The prefetch thread - waits for requests and decodes them until cancelled."""
+        while True:
+            # Wait for a request
+            with self.condition:
+                while self.target is None and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    break
+                (target, on_frame_ready), generation, velocity = self.target, self.generation, self.velocity
+                self.target = None
+            for frame_num in self.prefetch_order(target, velocity):
+                # Stop if there is a newer request (or we are stopping)
+                if self.generation != generation or self.stopped:
+                    break
+                # Decode it unless it is already cached
+                frame = self.frame_cache.get(frame_num)
+                if frame is None:
+                    frame = get_frame(self.cap, frame_num - 1, seek_index=self.seek_index)
+                    self.frame_cache.put(frame_num, frame)
+                # Let the requester know the requested frame is ready (or failed)
+                if frame_num == target and on_frame_ready is not None:
+                    on_frame_ready(frame_num, frame)
+        self.captures.release(self.cap)
+
+    def stop(self):
+        """Stops the thread (it finishes the frame it is decoding first)."""
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+
+class ProxyVideo():
+    """Low resolution copy of a video, used to navigate it quickly (thumbnails and coarse scrubbing).
+    - the proxy is made in a background thread the first time, then kept next to the video (see write_proxy)
+    - until it is ready, get_frame returns None
+    - every proxy frame is a JPEG, so reading any frame is cheap
+    - safe to share between threads"""
+
+    def __init__(self, vid_loc, num_frames, seek_index=None):
+        self.vid_loc = vid_loc
+        self.num_frames = num_frames
+        self.seek_index = seek_index
+        self.lock = threading.Lock()
+        self.stopped = False
+        # Use an existing proxy if there is one for this version of the video
+        self.cap = load_proxy(vid_loc, num_frames)
+        # Otherwise make it in the background
+        self.thread = None
+        if self.cap is None:
+            self.thread = threading.Thread(target=self.build, daemon=True)
+            self.thread.start()
+
+    def build(self):
+        """The build thread - writes the proxy video then opens it."""
+        # Wait for a free slot (so many videos aren't all decoded at once)
+        with PROXY_BUILD_SLOTS:
+            if self.stopped:
+                return
+            success = write_proxy(self.vid_loc, self.num_frames, seek_index=self.seek_index, should_stop=lambda: self.stopped)
+        if success and not self.stopped:
+            cap = load_proxy(self.vid_loc, self.num_frames)
+            with self.lock:
+                self.cap = cap
+
+    def get_frame(self, frame_num):
+        """Returns the proxy frame at the given frame number (1 -> num_frames), or None if not available."""
+        frame_num = min(max(frame_num, 1), self.num_frames)
+        with self.lock:
+            if self.cap is None:
+                return None
+            return get_frame(self.cap, frame_num - 1)
+
+    def stop(self):
+        """Stops making the proxy (if still being made) and closes it."""
+        self.stopped = True
+        with self.lock:
+            if self.cap is not None:
+                self.cap.release()
+                self.cap = None
+
+
+class ThumbnailDecoder():
+    """Background thread which decodes (and downsizes) thumbnails so the UI never waits on them.
+    - request() replaces any thumbnails still waiting to be decoded
+    - on_ready(key, image) is called from the decoder thread for each thumbnail, the image is a
+      downsized numpy array (kivy textures must be made on the main thread)
+    - frames are read from the experiment's proxy video if ready, otherwise from the video
+      with a VideoCapture checked out from the experiment's pool"""
+
+    def __init__(self, on_ready):
+        self.on_ready = on_ready
+        # Thumbnails waiting to be decoded, most urgent first
+        self.condition = threading.Condition()
+        self.jobs = []
+        self.stopped = False
+        # Start the thread
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def request(self, jobs):
+        """Sets the thumbnails to decode, a list of (key, experiment, frame_num, min_width, min_height)."""
+        with self.condition:
+            self.jobs = list(jobs)
+            self.condition.notify()
+
+    def read_frame(self, experiment, frame_num):
+        """Returns the frame for a thumbnail (1 -> num_frames) or None if it can't be read."""
+        # Use the proxy video if it is ready
+        frame = experiment.get_proxy_frame(frame_num)
+        if frame is not None:
+            return frame
+        try:
+            with experiment.captures.checkout(frame_num - 1) as cap:
+                return get_frame(cap, frame_num - 1, seek_index=experiment.seek_index)
+        except IOError as e:
+            print("Error:", e)
+            return None
+
+    def run(self):
+        """The decoder thread - waits for thumbnails to decode and decodes them one by one."""
+        while True:
+            # Wait for a thumbnail to decode
+            with self.condition:
+                while not self.jobs and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    break
+                key, experiment, frame_num, min_width, min_height = self.jobs.pop(0)
+            frame = self.read_frame(experiment, frame_num)
+            # If didn't work, use a blank image
+            if frame is None:
+                frame = np.ones(experiment.shape, dtype=np.uint8) * 255
+            self.on_ready(key, downsample_image(frame, min_width, min_height))
+
+    def stop(self):
+        """Stops the thread (it finishes the thumbnail it is decoding first)."""
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+
+class EventFrames():
+    """Lazy sequence of the frames of an event, used in place of a list of frames.
+    - indexing is the same as a list (0 is the first frame of the event)
+    - frames are decoded on access, in sequential chunks, so stepping through only seeks once per chunk
+    - at most window frames are kept in memory, call release() to free them
+    - if given a frame_array (e.g. a memory-mapped frame cache) frames are read from it instead,
+      release() drops it too and open_frame_array() is called to open it again when next needed"""
+
+    def __init__(self, captures, first_frame, last_frame, window, frame_array=None, open_frame_array=None, seek_index=None):
+        # The video's capture pool (and its seek index) and the range of frame positions in it
+        self.captures = captures
+        self.seek_index = seek_index
+        self.first_frame = first_frame
+        self.last_frame = last_frame
+        # Array of all the frames (if already decoded) and how to open it again once released
+        self.frame_array = frame_array
+        self.open_frame_array = open_frame_array
+        # Maximum number of frames kept in memory
+        self.window = max(1, window)
+        # Resident frames keyed by index (least recently used first)
+        self.frames = OrderedDict()
+        # The last index accessed (to know which direction we are stepping)
+        self.last_idx = None
+
+    def __len__(self):
+        return self.last_frame - self.first_frame + 1
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def __getitem__(self, idx):
+        """Returns the frame at the index, decoding it (and its neighbours) if needed."""
+        # Allow negative indexing like a list
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError("Event frame index out of range")
+        # If already decoded, read it directly (no copy)
+        frame_array = self.get_frame_array()
+        if frame_array is not None:
+            return frame_array[idx]
+        # If not resident, decode a chunk of frames in the direction we are stepping
+        if idx not in self.frames:
+            self.decode_chunk(idx, backwards=self.last_idx is not None and idx < self.last_idx)
+        self.last_idx = idx
+        # It is now the most recently used
+        self.frames.move_to_end(idx)
+        return self.frames[idx]
+
+    def get_frame_array(self):
+        """Returns the array of all the frames (opening it again if it was released), or None if there isn't one."""
+        if self.frame_array is None and self.open_frame_array is not None:
+            self.frame_array = self.open_frame_array()
+            # Don't keep trying if it can't be opened
+            if self.frame_array is None:
+                self.open_frame_array = None
+        return self.frame_array
+
+    def decode_chunk(self, idx, backwards=False):
+        """Decodes half a window of frames starting (or ending if backwards) at the index."""
+        chunk_size = max(1, self.window // 2)
+        # Get the range of indices to decode
+        if backwards:
+            start_idx, end_idx = max(0, idx - chunk_size + 1), idx
+        else:
+            start_idx, end_idx = idx, min(len(self) - 1, idx + chunk_size - 1)
+        # Decode them with a single seek
+        with self.captures.checkout(self.first_frame + start_idx) as cap:
+            frames = read_frame_range(cap, self.first_frame + start_idx, self.first_frame + end_idx, seek_index=self.seek_index)
+        for i, frame in zip(range(start_idx, end_idx + 1), frames):
+            self.frames[i] = frame
+            self.frames.move_to_end(i)
+        # Evict the least recently used frames (never the one being accessed)
+        while len(self.frames) > self.window:
+            oldest_idx = next(iter(self.frames))
+            if oldest_idx == idx:
+                self.frames.move_to_end(idx)
+                continue
+            del self.frames[oldest_idx]
+
+    def release(self):
+        """Frees all resident frames (and the frame array, if it can be opened again), 
+        they will be decoded (or opened) again if accessed."""
+        self.frames.clear()
+        self.last_idx = None
+        if self.open_frame_array is not None:
+            self.frame_array = None
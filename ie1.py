@@ -7,16 +7,33 @@ Author: Haig Bishop (haig.bishop@pg.canterbury.ac.nz)
 # Kivy imports
 from kivy.app import App
 from kivy.uix.screenmanager import Screen
-from kivy.properties import BooleanProperty
+from kivy.properties import BooleanProperty, StringProperty
 from kivy.clock import Clock
 
 # Import modules
 import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 # Import local modules
 from popup_elements import BackPopup, ErrorPopup
 from jobs import Experiment, ExperimentBox
-from file_management import is_ion_file, is_video_file, kivify_image, get_frame, open_file_dialog
+from file_management import is_ion_file, has_video_extension, is_image_stack, kivify_image, get_frame, open_file_dialog
+from image_stacks import image_stack_location
+
+# Number of videos opened at the same time when importing
+IMPORT_WORKERS = 4
+
+
+def import_experiment(file_loc):
+    """Opens a video file as an experiment (called on an import worker thread).
+    - returns None if the video cannot be read"""
+    try:
+        return Experiment(file_loc)
+    except Exception as e:
+        # Failed to read file
+        print("Failed to read video file: ", e)
+        return None
 
 
 class IE1Window(Screen):
@@ -24,6 +41,10 @@ class IE1Window(Screen):
     # True when at least one ion file is attached
     ion_file_attached = BooleanProperty(False)
     is_loading = BooleanProperty(False)
+    # True while videos are being imported in the background
+    is_importing = BooleanProperty(False)
+    # Text on the loading screen
+    loading_text = StringProperty("Loading...")
 
     def __init__(self, **kwargs):
         """init method for IE1 screen"""
@@ -31,6 +52,13 @@ class IE1Window(Screen):
         super(IE1Window, self).__init__(**kwargs)
         # Save app as an attribute
         self.app = App.get_running_app()
+        # Opens videos in the background
+        self.import_pool = ThreadPoolExecutor(max_workers=IMPORT_WORKERS)
+        # Videos being imported (file loc -> future) and progress
+        self.importing = {}
+        self.num_imported, self.num_to_import = 0, 0
+        # True if any video of this import was added / could not be read
+        self.import_added, self.import_failed = False, False
 
     def schedule_with_load(self, function):
         """Schedules a function call and sets loading to True."""
@@ -82,9 +110,13 @@ class IE1Window(Screen):
         vid_loc_list = []
         # Loop all experiments
         for exp in self.app.experiments:
-            cap = exp.cap
-            # Get the first frame
-            first_frame = get_frame(cap, 1)
+            # Get the first frame (None if the video can't be opened, e.g. it was removed)
+            try:
+                with exp.captures.checkout(1) as cap:
+                    first_frame = get_frame(cap, 1)
+            except IOError as e:
+                print("Error:", e)
+                first_frame = None
             # If couldn't read video
             if first_frame is None:
                 errors.append("cannot read video file (" + str(exp.name) + ")\n")
@@ -159,7 +191,7 @@ class IE1Window(Screen):
         """called when [select video file(s)] button is pressed
         - opens the file select window
         - selection is sent to self.selected()"""
-        filters = [("Video files", "*.avi", "*.mp4", "*.wmv")]
+        filters = [("Video files", "*.avi", "*.mp4", "*.wmv"), ("Image stacks", "*.tif", "*.tiff", "*.png")]
         open_file_dialog(on_selection=self.vid_selected, title="Select file(s)", filters=filters, multiple=True)
 
     def select_ion_file(self, *args):
@@ -172,22 +204,24 @@ class IE1Window(Screen):
     def vid_selected(self, selection):
         """receives selection from selector window
         - checks if the selections are valid
-        - if they are it adds them as experiments
+        - if they are it imports them as experiments in the background (see add_imported_experiment)
         - if any are not valid it will display an error string"""
         # Set booleans to test if selection is valid
         no_valid, duplicate, invalid_type = True, False, False
         for file_loc in selection:
-            # If is is a genuine selection of valid type
-            if is_video_file(file_loc):
-                # If it doesn't already exist
-                if not self.app.duplicate_experiment_vid(file_loc):
-                    # Create a experiment object
-                    new_experiment = Experiment(file_loc)
-                    # Add to the list
-                    self.app.add_experiment(new_experiment)
-                    # Create the accompanying list box
-                    new_exp_box = ExperimentBox(new_experiment, self)
-                    self.exp_scroll.grid_layout.add_widget(new_exp_box)
+            # If is is a genuine selection of valid type (a video or an image stack)
+            # (the file is opened and checked by the import)
+            if has_video_extension(file_loc) or is_image_stack(file_loc):
+                # Any image of an image sequence is imported as the whole sequence (so only once)
+                if not has_video_extension(file_loc):
+                    file_loc = image_stack_location(file_loc)
+                # If it doesn't already exist (and isn't being imported)
+                if not self.app.duplicate_experiment_vid(file_loc) and file_loc not in self.importing:
+                    # Open it as an experiment in the background
+                    future = self.import_pool.submit(import_experiment, file_loc)
+                    self.importing[file_loc] = future
+                    future.add_done_callback(partial(self.on_import_done, file_loc))
+                    self.num_to_import += 1
                     no_valid = False
                 # It is a duplicate!
                 else:
@@ -195,8 +229,8 @@ class IE1Window(Screen):
             # It is invalid type!
             else:
                 invalid_type = True
-        # If none are valid
-        if no_valid:
+        # If none are valid (and nothing else is importing)
+        if no_valid and not self.importing:
             # Deselect any jobs, update location label
             self.app.deselect_all_experiments()
             # Disable layouts
@@ -204,14 +238,11 @@ class IE1Window(Screen):
             self.name_grid_layout.disabled = True
             # Done loading
             self.is_loading = False
-        else:
-            # Set the last experiment added as the current job
-            self.app.select_experiment(new_experiment)
-            # Enable layouts
-            self.param_grid_layout.disabled = False
-            self.name_grid_layout.disabled = False
-            # Schedule to try to select an ion file for these new experiments
-            Clock.schedule_once(self.try_select_ions)
+        elif not no_valid:
+            # Show the progress on the loading screen
+            self.is_loading = True
+            self.is_importing = True
+            self.update_loading_text()
         # Update everything visually
         self.update_fields()
         # If there was a failed selection
@@ -227,6 +258,81 @@ class IE1Window(Screen):
             # Update location label
             self.location_label.text = error_string
 
+    def on_import_done(self, file_loc, future):
+        """Called (from an import worker thread) when a video has been imported or cancelled."""
+        # Add it on the main thread
+        Clock.schedule_once(lambda dt: self.add_imported_experiment(file_loc, future))
+
+    def add_imported_experiment(self, file_loc, future):
+        """Adds an imported experiment and its box to the list, as soon as it is ready."""
+        # If the import was cancelled, ignore it
+        if self.importing.get(file_loc) is not future:
+            return
+        del self.importing[file_loc]
+        self.num_imported += 1
+        new_experiment = None if future.cancelled() else future.result()
+        # If it couldn't be read
+        if new_experiment is None:
+            self.import_failed = True
+        # (check again for duplicates, it may have been added while importing)
+        elif not self.app.duplicate_experiment_obj(new_experiment):
+            # Add to the list
+            self.app.add_experiment(new_experiment)
+            # Create the accompanying list box
+            new_exp_box = ExperimentBox(new_experiment, self)
+            self.exp_scroll.grid_layout.add_widget(new_exp_box)
+            # Set the last experiment added as the current job
+            self.app.select_experiment(new_experiment)
+            self.import_added = True
+        # If that was the last one
+        if not self.importing:
+            self.finish_import()
+        else:
+            self.update_loading_text()
+
+    def update_loading_text(self):
+        """Shows the import progress on the loading screen."""
+        self.loading_text = "Loading... (" + str(self.num_imported) + "/" + str(self.num_to_import) + ")"
+
+    def cancel_import(self):
+        """Called by the 'Cancel' button on the loading screen - stops importing videos.
+        - videos already imported are kept"""
+        # Stop the videos which haven't started (the rest are ignored when done)
+        for future in self.importing.values():
+            future.cancel()
+        self.importing.clear()
+        self.finish_import()
+
+    def finish_import(self):
+        """Called when all videos have been imported (or the import is cancelled)."""
+        added, failed = self.import_added, self.import_failed
+        # Reset the progress
+        self.is_importing = False
+        self.loading_text = "Loading..."
+        self.num_imported, self.num_to_import = 0, 0
+        self.import_added, self.import_failed = False, False
+        # If none were added
+        if not added:
+            # Deselect any jobs, update location label
+            self.app.deselect_all_experiments()
+            # Disable layouts
+            self.param_grid_layout.disabled = True
+            self.name_grid_layout.disabled = True
+            # Done loading
+            self.is_loading = False
+        else:
+            # Enable layouts
+            self.param_grid_layout.disabled = False
+            self.name_grid_layout.disabled = False
+            # Schedule to try to select an ion file for these new experiments
+            Clock.schedule_once(self.try_select_ions)
+        # Update everything visually
+        self.update_fields()
+        # If any couldn't be read
+        if failed:
+            # Update location label
+            self.location_label.text = "Unreadable video file(s)"
+
     def ion_selected(self, selection, experiment=None, *args):
         if experiment is None:
             experiment = self.app.current_experiment
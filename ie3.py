@@ -12,6 +12,7 @@ from kivy.uix.image import Image
 from kivy.uix.label import Label
 from kivy.uix.boxlayout import BoxLayout
 from kivy.metrics import dp
+from kivy.clock import Clock
 
 # Import modules
 import cv2
@@ -19,12 +20,14 @@ import numpy as np
 from math import exp
 import re
 from datetime import datetime
+from collections import OrderedDict
 import os
 
 # Import local modules
 from popup_elements import BackPopup, ErrorPopup
 from jobs import ExperimentBox
-from file_management import resource_path, align_sig_to_frames, write_experiment_json, kivify_image, split_min_max, generate_y_axis_labels, downsample_image
+from frames import ThumbnailDecoder
+from file_management import resource_path, align_sig_to_frames, write_experiment_json, kivify_image, split_min_max, generate_y_axis_labels
 
 # Set constants
 ION_BACKGROUND_SHADE = 245
@@ -35,6 +38,12 @@ ION_EVENT_EDGE_COLOUR = (82, 82, 82)
 ION_EVENT_START_COLOUR = (242, 144, 39)
 ION_CURSOR_COLOUR = (0, 0, 255)
 WHITE = (1, 1, 1, 1)
+# Seconds the slider must rest before the full resolution frame is decoded (when using a proxy video)
+FULL_RES_DELAY = 0.15
+# Maximum number of thumbnail textures kept for reuse
+THUMBNAIL_CACHE_SIZE = 512
+# Shade of the placeholder shown until a thumbnail is decoded
+THUMBNAIL_PLACEHOLDER_SHADE = 64
 
 
 class IE3Window(Screen):
@@ -59,6 +68,8 @@ class IE3Window(Screen):
         super(IE3Window, self).__init__(**kwargs)
         # Save app as an attribute
         self.app = App.get_running_app()
+        # Scheduled decode of the full resolution frame (once the slider stops)
+        self.full_res_event = None
 
     def on_proceed(self):
         """called by pressing the 'Proceed' button."""
@@ -79,6 +90,9 @@ class IE3Window(Screen):
             for exp_box in self.exp_scroll.grid_layout.children:
                 # Get the experiment object
                 experiment = exp_box.experiment
+                # Frames are no longer needed in the background
+                experiment.stop_prefetcher()
+                experiment.stop_proxy()
                 # We using ion and have ion?
                 use_ion = self.use_ion and experiment.ion_loc != ''
                 # If exporting as a JSON file
@@ -165,6 +179,8 @@ class IE3Window(Screen):
             # Create the accompanying list box
             new_exp_box = ExperimentBox(experiment, self)
             self.exp_scroll.grid_layout.add_widget(new_exp_box)
+            # Start making its low resolution proxy video in the background
+            experiment.start_proxy()
         # Set the first experiment added as the current job
         self.app.deselect_all_experiments()
         self.app.select_experiment(self.app.experiments[0])
@@ -216,13 +232,52 @@ class IE3Window(Screen):
             self.thumbnail_bar.cursor_x = -9999
 
     def update_video(self):
-        """Update the video view by displaying the current frame."""
+        """Update the video view by displaying the current frame.
+        - only frames which are already decoded are displayed, so scrubbing never waits on decoding
+        - while scrubbing, the low resolution proxy frame is displayed (if the proxy is ready)
+          and the full resolution frame is only decoded once the slider stops
+        - other frames are decoded in the background and displayed when ready"""
         # If there is a current experiment
         current = self.app.current_experiment
         if current is not None:
-            image = current.get_frame(current.current_frame)
-            # Convert the image to a format useable for Kivy
-            self.video_widget.texture = kivify_image(image)
+            image = current.get_cached_frame(current.current_frame)
+            # If already decoded
+            if image is not None:
+                # Convert the image to a format useable for Kivy
+                self.video_widget.texture = kivify_image(image)
+                # Decode the frames ahead of it in the background
+                current.prefetch_frame(current.current_frame)
+                return
+            # Show the proxy frame (if ready) until the full resolution frame is decoded
+            proxy_image = current.get_proxy_frame(current.current_frame)
+            if proxy_image is not None:
+                self.video_widget.texture = kivify_image(proxy_image)
+                # Decode the full resolution frame once the slider stops
+                if self.full_res_event is not None:
+                    self.full_res_event.cancel()
+                self.full_res_event = Clock.schedule_once(self.decode_full_res_frame, FULL_RES_DELAY)
+            else:
+                # Decode this frame and the frames ahead of it in the background
+                current.prefetch_frame(current.current_frame, on_frame_ready=self.on_frame_prefetched)
+
+    def decode_full_res_frame(self, dt):
+        """Called once the slider stops on a frame that was shown from the proxy video.
+        - decodes the full resolution frame in the background and displays it when ready"""
+        self.full_res_event = None
+        current = self.app.current_experiment
+        if current is not None:
+            current.prefetch_frame(current.current_frame, on_frame_ready=self.on_frame_prefetched)
+
+    def on_frame_prefetched(self, frame_num, image):
+        """Called from the prefetch thread when a requested frame is decoded.
+        - displays it on the main thread if it is still the current frame (a blank frame if it couldn't be decoded)"""
+        def show_frame(dt):
+            current = self.app.current_experiment
+            if current is not None and current.current_frame == frame_num:
+                # If didn't work, use a blank image
+                frame = image if image is not None else np.ones(current.shape, dtype=np.uint8) * 255
+                self.video_widget.texture = kivify_image(frame)
+        Clock.schedule_once(show_frame)
     
 
     def update_current_frame(self):
@@ -703,6 +758,10 @@ class IE3Window(Screen):
             self.video_slider.value = new_value
         # Update bools
         self.ready_for_start = False if current is None else current.event_start_frame is None
+        # Only the current experiment needs frames decoded in the background
+        for experiment in self.app.experiments:
+            if experiment is not current:
+                experiment.stop_prefetcher()
         # Reset zoom
         self.zoom_start = 0
         self.zoom_end = 1
@@ -999,6 +1058,11 @@ class ThumbnailBar(BoxLayout):
         super(ThumbnailBar, self).__init__(**kwargs)
         # Save app as an attribute
         self.app = App.get_running_app()
+        # Thumbnail textures keyed by (video, frame number, min width, min height) (least recently used first)
+        self.textures = OrderedDict()
+        self.placeholder_texture = None
+        # Decodes thumbnails in the background
+        self.decoder = ThumbnailDecoder(self.on_thumbnail_decoded)
 
     def on_size(self, instance, current_size):
         """Called when size of widget changes."""
@@ -1030,7 +1094,9 @@ class ThumbnailBar(BoxLayout):
                 self.ie3_window.zoom_out()
 
     def update_thumbnails(self, different_exp=False):
-        """Checks current experiment's frames and dimensions of thumbnail bar to update the thumbnail bar."""
+        """Checks current experiment's frames and dimensions of thumbnail bar to update the thumbnail bar.
+        - thumbnail widgets are reused and thumbnail textures are cached, so only new thumbnails are decoded
+        - new thumbnails are decoded in the background, showing a placeholder until they are ready"""
         # If there is a current experiment
         current = self.app.current_experiment
         if current is not None:
@@ -1043,33 +1109,78 @@ class ThumbnailBar(BoxLayout):
             if num_thumbnails > current.num_frames:
                 # Use all frames (do our best lol)
                 num_thumbnails = current.num_frames
-            # If either [the number of thumbnails] or [the current experiment] is changing
-            if self.num_thumbnails != num_thumbnails or different_exp:
-                # Update the thumbnail bar
-                # Clear all thumbnails objects
-                self.clear_widgets()
-                # Makes all thumbnail objects
-                for i in range(num_thumbnails):
-                    # Get the proportion through the video
-                    prop = i / (num_thumbnails - 1)
-                    # Get frame to use
-                    start_frame = int((current.num_frames - 1) * self.ie3_window.zoom_start)
-                    end_frame = int((current.num_frames - 1) * self.ie3_window.zoom_end) + 1
-                    frame_range = end_frame - start_frame
-                    # Calculate the frame number based on the proportion
-                    frame_num = start_frame + int((frame_range) * (prop - 10e-8)) + 1 # 1 -> num_frames
-                    image = current.get_frame(frame_num)
-                    # Downsize frame
-                    min_width, min_height = int(bar_width / frame_width), int(bar_height)
-                    image = downsample_image(image, min_width, min_height)
-                    # Make and add thumbnail widget
-                    thumbnail = Thumbnail(self, frame_num, texture=kivify_image(image))
-                    self.add_widget(thumbnail)
-                # Update num_thumbnails
-                self.num_thumbnails = num_thumbnails
+            # Add or remove thumbnail widgets so there are the right number (reusing the rest)
+            while len(self.children) < num_thumbnails:
+                self.add_widget(Thumbnail(self, 1))
+            while len(self.children) > num_thumbnails:
+                self.remove_widget(self.children[0])
+            # Update num_thumbnails
+            self.num_thumbnails = max(1, num_thumbnails)
+            # Size to downsize frames to
+            min_width, min_height = int(bar_width / frame_width), int(bar_height)
+            # Thumbnails which need decoding
+            jobs = []
+            # For each thumbnail (children are in reverse order)
+            for i, thumbnail in enumerate(reversed(self.children)):
+                # Get the proportion through the video
+                prop = i / max(1, num_thumbnails - 1)
+                # Get frame to use
+                start_frame = int((current.num_frames - 1) * self.ie3_window.zoom_start)
+                end_frame = int((current.num_frames - 1) * self.ie3_window.zoom_end) + 1
+                frame_range = end_frame - start_frame
+                # Calculate the frame number based on the proportion
+                frame_num = start_frame + int((frame_range) * (prop - 10e-8)) + 1 # 1 -> num_frames
+                key = (current.vid_loc, frame_num, min_width, min_height)
+                thumbnail.frame_num = frame_num
+                thumbnail.key = key
+                # Use the cached texture if there is one
+                texture = self.get_texture(key)
+                if texture is not None:
+                    # (only if not already showing it)
+                    if thumbnail.texture is not texture:
+                        thumbnail.texture = texture
+                # Otherwise show a placeholder until it is decoded
+                else:
+                    thumbnail.texture = self.get_placeholder_texture()
+                    jobs.append((key, current, frame_num, min_width, min_height))
+            # Decode the new thumbnails (forgetting any which are no longer needed)
+            self.decoder.request(jobs)
         else:
             # Clear all thumbnails objects
             self.clear_widgets()
+            self.decoder.request([])
+
+    def get_texture(self, key):
+        """Returns the cached thumbnail texture or None if it is not cached."""
+        texture = self.textures.get(key)
+        # If it was cached
+        if texture is not None:
+            # It is now the most recently used
+            self.textures.move_to_end(key)
+        return texture
+
+    def get_placeholder_texture(self):
+        """Returns the texture shown while a thumbnail is being decoded."""
+        if self.placeholder_texture is None:
+            image = np.full((1, 1, 3), THUMBNAIL_PLACEHOLDER_SHADE, dtype=np.uint8)
+            self.placeholder_texture = kivify_image(image)
+        return self.placeholder_texture
+
+    def on_thumbnail_decoded(self, key, image):
+        """Called from the decoder thread when a thumbnail is decoded.
+        - makes its texture on the main thread, caches it and shows it"""
+        def show_thumbnail(dt):
+            # Make the texture and cache it
+            texture = kivify_image(image)
+            self.textures[key] = texture
+            # Forget the least recently used textures
+            while len(self.textures) > THUMBNAIL_CACHE_SIZE:
+                self.textures.popitem(last=False)
+            # Show it on any thumbnails waiting for it
+            for thumbnail in self.children:
+                if thumbnail.key == key:
+                    thumbnail.texture = texture
+        Clock.schedule_once(show_thumbnail)
         
     def update_cursor(self):
         """Updates the cursor x position (this will update the red line)."""
@@ -1097,6 +1208,8 @@ class Thumbnail(Image):
         self.ie3_window = self.app.root.get_screen("IE3")
         # Set the frame number as current frame
         self.frame_num = frame_num
+        # The key of the thumbnail texture it is showing (see ThumbnailBar.update_thumbnails)
+        self.key = None
 
     def set_as_frame(self, pos):
         """Sets this frame as current if touch is a left click on this thumbnail."""
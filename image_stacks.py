@@ -0,0 +1,305 @@
+"""
+Module:  All classes and functions related to reading image stacks (multi-page TIFF files and numbered image sequences)
+Program: Particle Deformation Analysis
+Author: Haig Bishop (haig.bishop@pg.canterbury.ac.nz)
+"""
+
+# Import modules
+import os
+import re
+import struct
+import cv2
+import numpy as np
+
+# Extensions of the images which can make up an image stack
+IMAGE_EXTENSIONS = ['.tif', '.tiff', '.png', '.bmp', '.jpg', '.jpeg']
+TIFF_EXTENSIONS = ['.tif', '.tiff']
+
+# TIFF tags needed to find the pixel data of a page
+TIFF_IMAGE_WIDTH = 256
+TIFF_IMAGE_LENGTH = 257
+TIFF_BITS_PER_SAMPLE = 258
+TIFF_COMPRESSION = 259
+TIFF_PHOTOMETRIC = 262
+TIFF_STRIP_OFFSETS = 273
+TIFF_SAMPLES_PER_PIXEL = 277
+TIFF_STRIP_BYTE_COUNTS = 279
+TIFF_PLANAR_CONFIGURATION = 284
+TIFF_TILE_WIDTH = 322
+# TIFF field types (SHORT and LONG) and their sizes
+TIFF_FIELD_TYPES = {3: ('H', 2), 4: ('I', 4)}
+
+
+def has_image_extension(file_loc):
+    """Checks if the file has a correct extension for an image of an image stack."""
+    return os.path.splitext(file_loc)[1].lower() in IMAGE_EXTENSIONS
+
+def is_image_stack(file_loc):
+    """Checks if the file (or folder) could be an image stack, without reading it.
+    - a TIFF file, an image of a numbered image sequence, or a folder of images"""
+    if os.path.isdir(file_loc):
+        return any(has_image_extension(name) for name in os.listdir(file_loc))
+    return has_image_extension(file_loc)
+
+def read_tiff_pages(file_loc):
+    """A minimal TIFF reader which finds the pixel data of every page of an uncompressed TIFF file.
+    - returns (data, pages) where data is the file memory-mapped as bytes,
+      and each page is (offset, shape, dtype, photometric)
+    - returns None if any page can't be memory-mapped (e.g. compressed, tiled or a BigTIFF)"""
+    try:
+        data = np.memmap(file_loc, dtype=np.uint8, mode='r')
+    except (OSError, ValueError):
+        return None
+    try:
+        # Read the header (byte order, magic number and offset of the first page)
+        byte_order = {b'II': '<', b'MM': '>'}.get(bytes(data[:2]))
+        if byte_order is None:
+            return None
+        magic, ifd_offset = struct.unpack_from(byte_order + 'HI', data, 2)
+        if magic != 42:
+            return None
+        pages = []
+        visited = set()
+        # For every page (image file directory)
+        while ifd_offset != 0:
+            # Stop if the file is broken
+            if ifd_offset in visited:
+                return None
+            visited.add(ifd_offset)
+            # Read the tags we need
+            tags = {}
+            (num_entries,) = struct.unpack_from(byte_order + 'H', data, ifd_offset)
+            for i in range(num_entries):
+                entry_offset = ifd_offset + 2 + 12 * i
+                tag, field_type, count = struct.unpack_from(byte_order + 'HHI', data, entry_offset)
+                if field_type not in TIFF_FIELD_TYPES:
+                    continue
+                code, size = TIFF_FIELD_TYPES[field_type]
+                # Small values are in the entry, others are elsewhere in the file
+                if count * size <= 4:
+                    value_offset = entry_offset + 8
+                else:
+                    (value_offset,) = struct.unpack_from(byte_order + 'I', data, entry_offset + 8)
+                tags[tag] = struct.unpack_from(byte_order + str(count) + code, data, value_offset)
+            (ifd_offset,) = struct.unpack_from(byte_order + 'I', data, ifd_offset + 2 + 12 * num_entries)
+            # Find where its pixels are
+            page = tiff_page_layout(tags, byte_order, len(data))
+            if page is None:
+                return None
+            pages.append(page)
+    except struct.error:
+        # Offsets past the end of the file
+        return None
+    return data, pages
+
+def tiff_page_layout(tags, byte_order, file_size):
+    """Returns (offset, shape, dtype, photometric) of a TIFF page's pixels from its tags.
+    - returns None unless the pixels are uncompressed, 8 or 16 bit and stored in one contiguous block"""
+    width = tags.get(TIFF_IMAGE_WIDTH, (0,))[0]
+    height = tags.get(TIFF_IMAGE_LENGTH, (0,))[0]
+    bits = tags.get(TIFF_BITS_PER_SAMPLE, (1,))
+    samples = tags.get(TIFF_SAMPLES_PER_PIXEL, (1,))[0]
+    photometric = tags.get(TIFF_PHOTOMETRIC, (1,))[0]
+    offsets = tags.get(TIFF_STRIP_OFFSETS, ())
+    byte_counts = tags.get(TIFF_STRIP_BYTE_COUNTS, ())
+    # Must be uncompressed, in strips, with the samples of each pixel together
+    if tags.get(TIFF_COMPRESSION, (1,))[0] != 1 or TIFF_TILE_WIDTH in tags:
+        return None
+    if samples > 1 and tags.get(TIFF_PLANAR_CONFIGURATION, (1,))[0] != 1:
+        return None
+    # Must be greyscale or RGB(A), 8 or 16 bit
+    if photometric not in (0, 1, 2) or len(set(bits)) != 1 or bits[0] not in (8, 16):
+        return None
+    if width == 0 or height == 0 or not offsets or len(offsets) != len(byte_counts):
+        return None
+    # The strips must follow each other (so the page is one block)
+    for i in range(len(offsets) - 1):
+        if offsets[i] + byte_counts[i] != offsets[i + 1]:
+            return None
+    dtype = np.dtype(byte_order + ('u1' if bits[0] == 8 else 'u2'))
+    shape = (height, width, samples)
+    if offsets[0] + height * width * samples * dtype.itemsize > file_size:
+        return None
+    return offsets[0], shape, dtype, photometric
+
+def count_tiff_pages(file_loc):
+    """Returns the number of pages in a TIFF file read with OpenCV (0 if it can't be read)."""
+    try:
+        return cv2.imcount(file_loc)
+    except (AttributeError, cv2.error):
+        return 0
+
+def find_image_sequence(file_loc):
+    """Returns the files of the numbered image sequence which file_loc belongs to, in order.
+    - file_loc can be any image of the sequence (e.g. frame_0001.png) or the folder containing it
+    - the images of a sequence have the same name apart from a number (the last number in the name)"""
+    # If a folder, use its first image
+    if os.path.isdir(file_loc):
+        directory = file_loc
+        image_names = sorted(name for name in os.listdir(directory) if has_image_extension(name))
+        if not image_names:
+            return []
+        file_name = image_names[0]
+    else:
+        directory, file_name = os.path.split(file_loc)
+    # Split the name around its last number
+    match = re.match(r'^(.*?)(\d+)(\D*)$', file_name)
+    if match is None:
+        return [os.path.join(directory, file_name)]
+    prefix, _, suffix = match.groups()
+    # Find all the files with the same name apart from the number
+    pattern = re.compile('^' + re.escape(prefix) + r'(\d+)' + re.escape(suffix) + '$')
+    numbered_names = []
+    for name in os.listdir(directory or '.'):
+        name_match = pattern.match(name)
+        if name_match is not None:
+            numbered_names.append((int(name_match.group(1)), name))
+    return [os.path.join(directory, name) for _, name in sorted(numbered_names)]
+
+def image_stack_location(file_loc):
+    """Returns the location which an image stack is imported from, so every image of a sequence gives the same one.
+    - a folder or a multi-page TIFF file is itself
+    - any image of a numbered image sequence is the first image of the sequence"""
+    if os.path.isdir(file_loc):
+        return file_loc
+    if os.path.splitext(file_loc)[1].lower() in TIFF_EXTENSIONS and count_tiff_pages(file_loc) > 1:
+        return file_loc
+    file_locs = find_image_sequence(file_loc)
+    return file_locs[0] if file_locs else file_loc
+
+def to_bgr8(image, shift=0, white_is_zero=False, rgb=False):
+    """Converts an image from an image stack to an 8-bit BGR image (like a frame read from a video).
+    - 16-bit images are shifted right by shift bits
+    - rgb is True if colour images are RGB rather than BGR (as OpenCV reads them)"""
+    # Reduce to 8-bit
+    if image.dtype == np.uint16:
+        image = (image >> shift).clip(0, 255).astype(np.uint8)
+    elif image.dtype != np.uint8:
+        image = cv2.convertScaleAbs(image)
+    if white_is_zero:
+        image = 255 - image
+    # Make it 3 channel BGR
+    if image.ndim == 2 or image.shape[2] == 1:
+        return cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+    if image.shape[2] == 4:
+        return cv2.cvtColor(image, cv2.COLOR_RGBA2BGR if rgb else cv2.COLOR_BGRA2BGR)
+    image = np.ascontiguousarray(image[:, :, :3])
+    return cv2.cvtColor(image, cv2.COLOR_RGB2BGR) if rgb else image
+
+
+class ImageStack():
+    """The frames of an image stack, read as 8-bit BGR images (like the frames of a video).
+    - a multi-page TIFF file: uncompressed pages are memory-mapped, so reading any frame is O(1),
+      other TIFF files are read a page at a time with OpenCV
+    - a numbered image sequence (or a folder of images): each frame is read from its own file
+    - 16-bit images are scaled to 8-bit using the brightest value in the first frame
+    - frames can be read in any order, from any thread"""
+
+    def __init__(self, stack_loc):
+        self.stack_loc = stack_loc
+        # Memory-mapped TIFF file and its pages (if used)
+        self.tiff = None
+        # Number of pages of a TIFF read with OpenCV (if used)
+        self.num_tiff_pages = 0
+        # Files of the image sequence (if used)
+        self.file_locs = []
+        # If a TIFF file with more than one page
+        if not os.path.isdir(stack_loc) and os.path.splitext(stack_loc)[1].lower() in TIFF_EXTENSIONS:
+            tiff = read_tiff_pages(stack_loc)
+            if tiff is not None and len(tiff[1]) > 1:
+                self.tiff = tiff
+            elif tiff is None:
+                self.num_tiff_pages = count_tiff_pages(stack_loc)
+        # Otherwise an image sequence
+        if self.tiff is None and self.num_tiff_pages <= 1:
+            self.num_tiff_pages = 0
+            self.file_locs = find_image_sequence(stack_loc)
+        # Bits to shift 16-bit frames by to make them 8-bit
+        self.shift = 0
+        first_image = self.read_image(0) if len(self) > 0 else None
+        if first_image is not None and first_image.dtype == np.uint16:
+            self.shift = max(0, int(first_image.max()).bit_length() - 8)
+
+    def __len__(self):
+        if self.tiff is not None:
+            return len(self.tiff[1])
+        if self.num_tiff_pages > 0:
+            return self.num_tiff_pages
+        return len(self.file_locs)
+
+    def read_image(self, frame_num):
+        """Returns the frame's image as stored (any bit depth) or None if it can't be read."""
+        # Memory-mapped TIFF page (no copy)
+        if self.tiff is not None:
+            data, pages = self.tiff
+            offset, shape, dtype, _ = pages[frame_num]
+            return np.ndarray(shape, dtype=dtype, buffer=data, offset=offset)
+        flags = cv2.IMREAD_ANYDEPTH | cv2.IMREAD_ANYCOLOR
+        # TIFF page read with OpenCV
+        if self.num_tiff_pages > 0:
+            try:
+                ret, images = cv2.imreadmulti(self.stack_loc, frame_num, 1, flags=flags)
+            except cv2.error:
+                return None
+            return images[0] if ret and images else None
+        # Image file of the sequence
+        return cv2.imread(self.file_locs[frame_num], flags)
+
+    def get_frame(self, frame_num):
+        """Returns the frame (0-based) as an 8-bit BGR image, or None if it can't be read."""
+        if not 0 <= frame_num < len(self):
+            return None
+        image = self.read_image(frame_num)
+        if image is None:
+            return None
+        # Memory-mapped TIFF pages are as stored (OpenCV has already made the rest BGR)
+        if self.tiff is not None:
+            photometric = self.tiff[1][frame_num][3]
+            return to_bgr8(image, shift=self.shift, white_is_zero=photometric == 0, rgb=photometric == 2)
+        return to_bgr8(image, shift=self.shift)
+
+
+class ImageStackCapture():
+    """Reads an image stack through the same methods as a cv2.VideoCapture
+    (read, grab, get, set, isOpened and release), so it can be used wherever one is.
+    - seeking is free, any frame can be read directly
+    - many captures can share one ImageStack, each has its own position"""
+
+    def __init__(self, image_stack):
+        self.image_stack = image_stack
+        # Position of the next frame to be read
+        self.position = 0
+
+    def isOpened(self):
+        return self.image_stack is not None and len(self.image_stack) > 0
+
+    def get(self, prop_id):
+        if self.image_stack is None:
+            return 0
+        if prop_id == cv2.CAP_PROP_POS_FRAMES:
+            return self.position
+        if prop_id == cv2.CAP_PROP_FRAME_COUNT:
+            return len(self.image_stack)
+        return 0
+
+    def set(self, prop_id, value):
+        if self.image_stack is None or prop_id != cv2.CAP_PROP_POS_FRAMES:
+            return False
+        self.position = int(value)
+        return True
+
+    def grab(self):
+        if self.image_stack is None or not 0 <= self.position < len(self.image_stack):
+            return False
+        self.position += 1
+        return True
+
+    def read(self):
+        if self.image_stack is None:
+            return False, None
+        frame = self.image_stack.get_frame(self.position)
+        self.position += 1
+        return frame is not None, frame
+
+    def release(self):
+        self.image_stack = None
@@ -7,11 +7,13 @@ Author: Haig Bishop (haig.bishop@pg.canterbury.ac.nz)
 # Kivy imports
 from kivy.uix.button import Button
 from kivy.uix.scrollview import ScrollView
-from kivy.properties import BooleanProperty
+from kivy.properties import BooleanProperty, StringProperty
 from kivy.app import App
 
 # Import modules
 import os
+import threading
+from functools import partial
 from platform import platform
 from subprocess import Popen as p_open
 from scipy.signal import decimate
@@ -20,14 +22,33 @@ import cv2
 import pandas as pd
 
 # Import local modules
-from file_management import read_vid, get_frame, count_frames, file_date, fft_and_filter, normalise_and_smooth_sig, align_sig_to_frames, read_tdms
-from tracking import detect_start, get_y_maximums_multiple_frame_crops
+from file_management import get_frame, iter_frame_range, probe_frame_count, file_identity, load_frame_cache, write_frame_cache, load_seek_index, build_seek_index, file_date, fft_and_filter, normalise_and_smooth_sig, align_sig_to_frames, read_tdms
+from tracking import detect_start, detect_pipette, pipette_moved, get_y_maximums_frame_stack, get_y_positions_search_window, iter_frame_batches, retrack_y_positions, smooth_y_positions, non_decreasing_y_positions
+from frames import CapturePool, FrameCache, EventFrames, FramePrefetcher, ProxyVideo
 
 # Desired size to downsample signal data
 # raw data is not discarded, this is only used for display
 # e.g. 250,000 yeilds new data in the range of 250,000-500,000
 DESIRED_SIGNAL_SIZE = 250000
 
+# Memory budget (in MB) for the decoded frames cached by each experiment
+FRAME_CACHE_SIZE_MB = 512
+
+# Maximum number of decoded frames each event keeps in memory
+EVENT_FRAME_WINDOW = 32
+
+# Cache each event's decoded frames on disk next to the experiment's JSON file (see Event.start_frame_cache)
+DISK_FRAME_CACHE = False
+# Maximum number of on-disk frame caches being written at the same time
+FRAME_CACHE_BUILD_SLOTS = threading.BoundedSemaphore(1)
+
+# Make low resolution proxy videos for navigating experiments (thumbnails and scrubbing)
+# (off by default, as it decodes every video in the background and writes a copy next to it)
+USE_PROXY_VIDEOS = False
+
+# Predict start points of very large frames (see COARSE_TO_FINE_MIN_SIZE) on a downscaled copy first (see detect_start)
+COARSE_TO_FINE_START = True
+
 
 class Experiment():
     """Object which represents a micro aspiration experiment.
@@ -35,17 +56,55 @@ class Experiment():
     The mutable object holds information on the experiment relevant to its analysis.
     Essentially each experiment is a video of an experiment, possibly alongside ion current data"""
     
-    def __init__(self, vid_loc):
+    def __init__(self, vid_loc, num_frames=None, cache_size_mb=FRAME_CACHE_SIZE_MB):
+        """num_frames can be given if already known (e.g. from a JSON file for this version of the video)"""
         # General
         self.name, self.file_extension = os.path.splitext(os.path.basename(vid_loc))
         self.directory, _ = os.path.split(vid_loc)
         # Video file
         self.vid_loc = vid_loc
         self.current_frame = 1
-        self.cap = read_vid(vid_loc)
-        self.first_frame = get_frame(self.cap, 1)
+        # Open video handles (each reader checks one out, so they don't move each other's position)
+        self.captures = CapturePool(vid_loc)
+        # Set if the "video" is an image stack (see image_stacks.py), which needs no seek index or proxy
+        self.image_stack = self.captures.image_stack
+        # Index of keyframes for fast seeking (built once and kept in a sidecar file)
+        self.seek_index = None
+        if self.image_stack is None:
+            self.seek_index = load_seek_index(vid_loc)
+            # If there isn't one, it is needed now to count the frames
+            # (importing is already done on a worker, JSON files give the number unless the video was replaced)
+            if self.seek_index is None and num_frames is None:
+                self.seek_index = build_seek_index(vid_loc)
+            # Otherwise build it in the background (frames are read without it until it is filled in)
+            elif self.seek_index is None:
+                self.seek_index = {}
+                threading.Thread(target=self.build_seek_index, daemon=True).start()
+        with self.captures.checkout(1) as cap:
+            self.first_frame = get_frame(cap, 1, seek_index=self.seek_index)
+        if self.first_frame is None:
+            raise ValueError("Could not read the first frame of " + vid_loc)
         self.shape = self.first_frame.shape
-        self.num_frames = count_frames(vid_loc)
+        # Number of frames from the seek index if not given (probe if the video can't be indexed)
+        if num_frames is None:
+            if self.image_stack is not None:
+                num_frames = len(self.image_stack)
+            elif self.seek_index is not None:
+                num_frames = self.seek_index['numFrames']
+            else:
+                num_frames = probe_frame_count(vid_loc)
+        self.num_frames = num_frames
+        # Recently decoded frames (keyed by frame number)
+        self.frame_cache = FrameCache(cache_size_mb)
+        # (first_frame is at capture index 1, which is frame number 2)
+        self.frame_cache.put(2, self.first_frame)
+        # Decodes frames in the background while scrubbing (made when first needed)
+        self.prefetcher = None
+        # Low resolution copy of the video for navigation (made when first needed)
+        self.proxy = None
+        # The pipette and contrast found by start point prediction (see get_pipette)
+        self.pipette = None
+        self.pipette_lock = threading.Lock()
         # Grab the dates of creation of the files
         self.vid_date = file_date(self.vid_loc)
         
@@ -73,6 +132,13 @@ class Experiment():
         # A JSON file attached to this exp which describes it and its event
         self.json_file_loc = None
     
+    def build_seek_index(self):
+        """The build thread - makes the seek index and fills it in.
+        - it is filled in place, as readers (e.g. each event's frames) share the same dictionary"""
+        seek_index = build_seek_index(self.vid_loc)
+        if seek_index is not None:
+            self.seek_index.update(seek_index)
+
     def add_ion_file(self, file_loc):
         """Reads a TDMS file and holds information in this object.
         - We can assume that the given file is readable as an ion current file"""
@@ -112,15 +178,81 @@ class Experiment():
         self.ion_frame_range = None
 
     def get_frame(self, frame_num):
-        """yeah"""
+        """Returns the frame (read-only) at the given frame number, reading through the frame cache."""
         frame_num = self.num_frames if frame_num > self.num_frames else frame_num
-        frame = get_frame(self.cap, frame_num - 1)
-        # If didn't work
+        # Try the cache first
+        frame = self.frame_cache.get(frame_num)
         if frame is None:
-            # Return a blank image
-            frame = np.ones(self.shape, dtype=np.uint8) * 255
+            try:
+                with self.captures.checkout(frame_num - 1) as cap:
+                    frame = get_frame(cap, frame_num - 1, seek_index=self.seek_index)
+            except IOError as e:
+                print("Error:", e)
+            # If didn't work
+            if frame is None:
+                # Return a blank image
+                frame = np.ones(self.shape, dtype=np.uint8) * 255
+            else:
+                # Keep it for next time
+                self.frame_cache.put(frame_num, frame)
         return frame
 
+    def get_cached_frame(self, frame_num):
+        """Returns the frame (read-only) at the given frame number if it is already decoded, otherwise None."""
+        frame_num = self.num_frames if frame_num > self.num_frames else frame_num
+        return self.frame_cache.get(frame_num)
+
+    def prefetch_frame(self, frame_num, on_frame_ready=None):
+        """Asks for the frame (and those ahead of it) to be decoded into the frame cache in the background.
+        - on_frame_ready(frame_num, frame) is called from the background thread once it is ready
+          (frame is None if it could not be decoded)"""
+        frame_num = self.num_frames if frame_num > self.num_frames else frame_num
+        # Start the prefetcher if needed
+        if self.prefetcher is None:
+            try:
+                self.prefetcher = FramePrefetcher(self.captures, self.frame_cache, self.num_frames, seek_index=self.seek_index)
+            except IOError as e:
+                print("Error:", e)
+                return
+        self.prefetcher.request(frame_num, on_frame_ready=on_frame_ready)
+
+    def stop_prefetcher(self):
+        """Stops decoding frames in the background (e.g. when no longer viewing this experiment)."""
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+            self.prefetcher = None
+
+    def get_pipette(self, frame):
+        """Returns the pipette (and contrast, see detect_pipette) in a frame of this experiment.
+        - the pipette is the same for every event, so it is only detected again if it has moved (or the lighting changed)
+        - safe to call from worker threads"""
+        with self.pipette_lock:
+            if self.pipette is None or pipette_moved(self.pipette, frame):
+                self.pipette = detect_pipette(frame, coarse_to_fine=COARSE_TO_FINE_START)
+            return self.pipette
+
+    def start_proxy(self):
+        """Starts making (or opens) the low resolution proxy video, if proxy videos are used.
+        - image stacks don't need one (any frame can already be read quickly)"""
+        if USE_PROXY_VIDEOS and self.proxy is None and self.image_stack is None:
+            self.proxy = ProxyVideo(self.vid_loc, self.num_frames, seek_index=self.seek_index)
+
+    def get_proxy_frame(self, frame_num):
+        """Returns the low resolution proxy frame at the given frame number, or None if the proxy isn't ready."""
+        if self.proxy is None:
+            return None
+        return self.proxy.get_frame(frame_num)
+
+    def stop_proxy(self):
+        """Stops making the proxy video (if still being made) and closes it."""
+        if self.proxy is not None:
+            self.proxy.stop()
+            self.proxy = None
+
+    def close_captures(self):
+        """Closes the experiment's video handles (e.g. when it is removed)."""
+        self.captures.close()
+
     def add_event(self, event):
         """Adds an event"""
         self.events.append(event)
@@ -129,8 +261,10 @@ class Experiment():
         """Clears all events"""
         self.events = []
     
-    def make_events(self, use_ion):
-        """Simply makes event objects for all events of this experiment using the self.event_ranges"""
+    def make_events(self, use_ion, disk_cache=False):
+        """Simply makes event objects for all events of this experiment using the self.event_ranges
+        - if disk_cache is True, each event's frames are cached on disk next to the experiment's JSON file
+          (in the background, see Event.start_frame_cache)"""
         # Make a list to hold all events
         events = []
         # If we have any events selected
@@ -139,9 +273,9 @@ class Experiment():
             if use_ion:
                 # Align/zoom signal to the video frames
                 aligned_signal = align_sig_to_frames(self.ioncurr_sig, self.num_frames, self.ion_frame_range)
-            # For every event
-            i = 1
-            for first_frame, last_frame in self.event_ranges:
+            # For every event (in order of frames, so the video is read forwards)
+            event_ids = {event_range: i for i, event_range in enumerate(self.event_ranges, start=1)}
+            for first_frame, last_frame in sorted(self.event_ranges):
                 # If using ion
                 if use_ion:
                     # Grab ion current data between first_frame and last_frame
@@ -154,11 +288,11 @@ class Experiment():
                 else:
                     ion_data = None
                 # Construct an event
-                event = Event(i, self, first_frame, last_frame, ion_data)
+                event = Event(event_ids[(first_frame, last_frame)], self, first_frame, last_frame, ion_data, disk_cache=disk_cache)
                 # Add to the list
                 events.append(event)
-                # next ID
-                i += 1
+            # Keep the events in order of ID
+            events.sort(key=lambda event: event.id)
         return events
 
 
@@ -211,6 +345,12 @@ class ExperimentList(ScrollView):
             box = self.grid_layout.children[0]
             # Remove current frame
             box.experiment.current_frame = 1
+            # Stop decoding its frames in the background
+            box.experiment.stop_prefetcher()
+            # If the experiment is being removed too, stop making its proxy video
+            if not boxes_only:
+                box.experiment.stop_proxy()
+                box.experiment.close_captures()
             # Remove the first box
             self.grid_layout.remove_widget(box)
         # If not only clearing boxes
@@ -256,7 +396,7 @@ class Event():
     There are many events that occur within one experiment.
     The mutable object holds information on the event relevant to its analysis."""
     
-    def __init__(self, id, experiment, first_frame_num, last_frame_num, ion_data):
+    def __init__(self, id, experiment, first_frame_num, last_frame_num, ion_data, disk_cache=False):
         # General
         self.id = id
         self.experiment = experiment
@@ -266,9 +406,15 @@ class Event():
         self.first_frame_num = first_frame_num
         self.last_frame_num = last_frame_num
         self.num_frames = last_frame_num - first_frame_num + 1
-        self.first_frame = get_frame(self.experiment.cap, first_frame_num)
-        # Avoid accessing this list directly, use the get_frame method instead, which uses frame numbering
-        self.all_frames = [get_frame(self.experiment.cap, i) for i in range(first_frame_num, last_frame_num + 1)]
+        with self.experiment.captures.checkout(first_frame_num) as cap:
+            self.first_frame = get_frame(cap, first_frame_num, seek_index=self.experiment.seek_index)
+        # Avoid accessing this directly, use the get_frame method instead, which uses frame numbering
+        # (frames are decoded lazily, only a window of them is kept in memory)
+        self.all_frames = EventFrames(self.experiment.captures, first_frame_num, last_frame_num, EVENT_FRAME_WINDOW, 
+                                      seek_index=self.experiment.seek_index)
+        # Frames are read from the on-disk cache once it is ready (if used)
+        if disk_cache:
+            self.start_frame_cache()
        
         # Ion current file
         self.ion_data = ion_data
@@ -281,6 +427,10 @@ class Event():
         self.right_bottom_x = None
         self.distortion_y_positions = None
         self.crop_region = None
+        # Weighted brightness of each row of each frame's crop (from tracking, for retrack_distortion)
+        self.brightness_profiles = None
+        # Indices of the frames whose distortion was corrected by hand (kept when tracking again)
+        self.distortion_anchors = set()
 
         # A CSV file attached to this event which describes it and its event
         self.csv_file_loc = None
@@ -304,11 +454,70 @@ class Event():
         # Return the frame
         return self.all_frames[idx]
 
-    def predict_start(self):
+    def start_frame_cache(self):
+        """Starts reading this event's frames from the on-disk cache (memory-mapped).
+        - the cache lives next to the experiment's JSON file
+        - it is (re)built in a background thread if missing or if the video file or frame range has changed,
+          until then frames are decoded as usual
+        - does nothing if there is no JSON file"""
+        # Only cache events of experiments with a JSON file
+        if self.experiment.json_file_loc is None:
+            return
+        cache_loc, key = self.frame_cache_location()
+        # Use the existing cache, otherwise decode the frames into a new one
+        frame_array = load_frame_cache(cache_loc, key)
+        if frame_array is not None:
+            self.use_frame_cache(frame_array, cache_loc, key)
+        else:
+            threading.Thread(target=self.build_frame_cache, args=(cache_loc, key), daemon=True).start()
+
+    def build_frame_cache(self, cache_loc, key):
+        """The build thread - decodes the frames into the on-disk cache then starts using it."""
+        # Wait for a free slot (so many events aren't all decoded at once)
+        with FRAME_CACHE_BUILD_SLOTS:
+            with self.experiment.captures.checkout(self.first_frame_num) as cap:
+                frame_array = write_frame_cache(cap, self.first_frame_num, self.last_frame_num, self.experiment.shape, 
+                                                cache_loc, key, seek_index=self.experiment.seek_index)
+        if frame_array is not None:
+            self.use_frame_cache(frame_array, cache_loc, key)
+
+    def use_frame_cache(self, frame_array, cache_loc, key):
+        """Reads frames from the (memory-mapped) on-disk cache from now on, reopening it after release_frames."""
+        self.all_frames.open_frame_array = partial(load_frame_cache, cache_loc, key)
+        self.all_frames.frame_array = frame_array
+
+    def frame_cache_location(self):
+        """Returns where this event's on-disk frame cache is and the key (dict) it must have to be valid."""
+        cache_loc = os.path.join(os.path.dirname(self.experiment.json_file_loc), self.name + '_frames.npy')
+        # The cache is only valid for this version of the video and this range of frames
+        vid_identity = file_identity(self.experiment.vid_loc)
+        key = {
+            'videoPath' : vid_identity['path'],
+            'videoSize' : vid_identity['size'],
+            'videoModified' : vid_identity['modified'],
+            'startFrame' : self.first_frame_num,
+            'endFrame' : self.last_frame_num,
+        }
+        return cache_loc, key
+
+    def release_frames(self):
+        """Frees the decoded frames held by this event (e.g. when it is no longer current)."""
+        self.all_frames.release()
+
+    def detect_start(self):
+        """Runs the first frame through the start point algorithm (reusing the experiment's pipette) and returns the result.
+        - doesn't change the event, so it can be called from a worker thread"""
+        return detect_start(self.first_frame, display=False, pipette=self.experiment.get_pipette(self.first_frame), 
+                            coarse_to_fine=COARSE_TO_FINE_START)
+
+    def predict_start(self, prediction=None):
         """Predict the position, angle, etc of the start point.
-        Then, update those values so they can be displayed... or exported etc."""
+        Then, update those values so they can be displayed... or exported etc.
+        - prediction is the result of detect_start, if it has already been run (e.g. on a worker)"""
         # Run the first frame through the algorithm
-        particle_pos, particle_radius, pipette_angle, left_bottom_x, right_bottom_x = detect_start(self.first_frame, display=False)
+        if prediction is None:
+            prediction = self.detect_start()
+        particle_pos, particle_radius, pipette_angle, left_bottom_x, right_bottom_x = prediction
         # Update the values 
         # These values were made for a different purpose unfortunately, but we are repurposing them :)
         self.particle_pos = (int(particle_pos[0]), int(particle_pos[1]))
@@ -347,8 +556,25 @@ class Event():
         self.pipette_tip_centre_x = x_centre
         self.pipette_tip_slope = pipette_tip_slope
 
-    def track_distortion(self):
-        """Tracks the distortion of the particle"""
+    def track_distortion(self, search_window=None, streaming=False):
+        """Tracks the distortion of the particle
+        - if search_window is given, only that many rows either side of the last position are searched in each frame
+          (see track_distortion_search_window), otherwise every row of every frame is
+        - if streaming is True, frames are tracked a few at a time as they are decoded (see track_distortion_chunk), 
+          so only a few crops are held in memory however long the event is (a search window always does this)"""
+        crop_region, starting_smooth_position = self.get_tracking_crop()
+        brightness_profiles = None
+        if search_window is None:
+            y_maximums, brightness_profiles = self.track_distortion_chunk(crop_region, return_brightness=True, 
+                                                                          streaming=streaming)
+        else:
+            # (these are already smoothed, smoothing them again changes nothing)
+            y_maximums = self.track_distortion_search_window(crop_region, starting_smooth_position, search_window)
+        self.finish_tracking(y_maximums, crop_region, starting_smooth_position, brightness_profiles)
+
+    def get_tracking_crop(self):
+        """Returns where to crop the frames to track the distortion (top_y, bottom_y, left_x, right_x)
+        and the position smoothing starts at (in terms of the cropped frames)"""
         # Determine where to crop the images
         num_radii_below_top_of_particle = 0.35
         num_pixels_below_top_of_particle = int(num_radii_below_top_of_particle * self.particle_radius)
@@ -365,23 +591,131 @@ class Event():
         left_x = max(0, int(self.particle_pos[0] - crop_width // 2))
         right_x = min(self.first_frame.shape[1], int(self.particle_pos[0] + crop_width // 2))
 
-        # Get all cropped frames
-        cropped_frames = []
-        for frame in self.all_frames:
-            cropped = frame[top_y:bottom_y, left_x:right_x]
-            cropped_frames.append(cropped)
-
         # Smoothing starts at the top of the particle (but in terms of the cropped image)
         starting_smooth_position = int(num_radii_above_particle * self.particle_radius) + 1
-        # Use get_y_maximums_multiple_frame_crops to predict the distortion
-        # (y_maximums is a list of y positions, starting at 1 (top of cropped image) and goes to the bottom of the cropped image)
-        y_maximums = get_y_maximums_multiple_frame_crops(cropped_frames, smooth=True, non_decreasing=True, 
-                                                         starting_smooth_position=starting_smooth_position, 
-                                                         display=False)
+        return (top_y, bottom_y, left_x, right_x), starting_smooth_position
+
+    def read_cropped_frames(self, crop_region, start_idx=0, end_idx=None):
+        """Returns the frames of the event from start_idx to end_idx (inclusive, 0 is the first frame) as one array, 
+        cropped to the crop region (top_y, bottom_y, left_x, right_x).
+        - frames are decoded (or read from the on-disk frame cache, see start_frame_cache) one at a time and only their crops are kept
+        - doesn't use the resident frames of all_frames, so it can be called from a worker thread"""
+        if end_idx is None:
+            end_idx = self.num_frames - 1
+        top_y, bottom_y, left_x, right_x = crop_region
+        cropped_frames = np.empty((end_idx - start_idx + 1, bottom_y - top_y, right_x - left_x) + self.first_frame.shape[2:], dtype=np.uint8)
+        # If the frames are cached on disk, crop them all at once
+        frame_array = self.all_frames.get_frame_array()
+        if frame_array is not None:
+            cropped_frames[:] = frame_array[start_idx:end_idx + 1, top_y:bottom_y, left_x:right_x]
+        else:
+            for i, cropped_frame in enumerate(self.iter_cropped_frames(crop_region, start_idx, end_idx)):
+                cropped_frames[i] = cropped_frame
+        return cropped_frames
+
+    def iter_cropped_frames(self, crop_region, start_idx=0, end_idx=None):
+        """Yields the frames of the event from start_idx to end_idx (inclusive, 0 is the first frame) one at a time, 
+        cropped to the crop region (top_y, bottom_y, left_x, right_x).
+        - each frame is decoded (or read from the on-disk frame cache, see start_frame_cache) as it is needed, and only its crop is kept
+        - doesn't use the resident frames of all_frames, so it can be used from a worker thread"""
+        if end_idx is None:
+            end_idx = self.num_frames - 1
+        top_y, bottom_y, left_x, right_x = crop_region
+        # If the frames are cached on disk, crop them directly
+        frame_array = self.all_frames.get_frame_array()
+        if frame_array is not None:
+            for idx in range(start_idx, end_idx + 1):
+                yield np.array(frame_array[idx, top_y:bottom_y, left_x:right_x])
+        else:
+            first_frame_num, last_frame_num = self.first_frame_num + start_idx, self.first_frame_num + end_idx
+            with self.experiment.captures.checkout(first_frame_num) as cap:
+                for frame in iter_frame_range(cap, first_frame_num, last_frame_num, seek_index=self.experiment.seek_index):
+                    yield frame[top_y:bottom_y, left_x:right_x].copy()
+
+    def track_distortion_chunk(self, crop_region, start_idx=0, end_idx=None, return_brightness=False, streaming=False):
+        """Returns the unsmoothed y positions of the distortion (1 is the top of the crop) for the frames from start_idx to end_idx
+        - the frames are independent until they are smoothed, so chunks of an event can be tracked separately (see finish_tracking)
+        - if return_brightness is True, also returns the brightness profile of each frame (see retrack_distortion)
+        - if streaming is True, the crops are tracked a few at a time as they are decoded instead of all at once
+          (the same positions, but only a few crops are held in memory)"""
+        # Use get_y_maximums_frame_stack to predict the distortion
+        if not streaming:
+            return get_y_maximums_frame_stack(self.read_cropped_frames(crop_region, start_idx, end_idx), 
+                                              return_brightness=return_brightness)
+        batches = [get_y_maximums_frame_stack(batch, return_brightness=return_brightness) 
+                   for batch in iter_frame_batches(self.iter_cropped_frames(crop_region, start_idx, end_idx))]
+        if not batches:
+            # (no frames, so nothing is held either way)
+            return self.track_distortion_chunk(crop_region, start_idx, end_idx, return_brightness=return_brightness)
+        if return_brightness:
+            return tuple(np.concatenate(parts) for parts in zip(*batches))
+        return np.concatenate(batches)
+
+    def track_distortion_search_window(self, crop_region, starting_position, search_window, start_idx=0, end_idx=None):
+        """Returns the smoothed y positions of the distortion (1 is the top of the crop) for the frames from start_idx to end_idx,
+        only searching search_window rows either side of the last position in each frame (see get_y_positions_search_window)
+        - each position depends on the last, so starting_position is the position of the frame before start_idx
+          (or where smoothing starts if start_idx is 0) and chunks have to be tracked one after another"""
+        if start_idx == 0:
+            return get_y_positions_search_window(self.iter_cropped_frames(crop_region, 0, end_idx), starting_position, 
+                                                 window=search_window)
+        # Start from the frame before (whose position is the starting position)
+        y_positions = get_y_positions_search_window(self.iter_cropped_frames(crop_region, start_idx - 1, end_idx), 
+                                                    starting_position, window=search_window)
+        return y_positions[1:]
+
+    def finish_tracking(self, y_maximums, crop_region, starting_smooth_position, brightness_profiles=None):
+        """Smooths the y positions of all frames of the event (from track_distortion_chunk) and saves them.
+        - brightness_profiles (if given) are kept so that corrections can be tracked from (see retrack_distortion)"""
+        # (y_maximums is an array of y positions, starting at 1 (top of cropped image) and goes to the bottom of the cropped image)
+        if len(y_maximums) > 0:
+            y_maximums = smooth_y_positions(y_maximums, starting_smooth_position)
+        y_maximums = non_decreasing_y_positions(y_maximums)
 
         # Convert these positions to be relative to the uncropped frames and save as attributes
-        self.distortion_y_positions = [y + top_y - 1 for y in y_maximums]
-        self.crop_region = (top_y, bottom_y, left_x, right_x)
+        # (as a compact int32 array)
+        top_y = crop_region[0]
+        self.distortion_y_positions = y_maximums.astype(np.int32, copy=False) + np.int32(top_y - 1)
+        self.crop_region = crop_region
+        self.brightness_profiles = brightness_profiles
+        # (any corrections were to the old positions)
+        self.distortion_anchors = set()
+
+    def retrack_distortion(self, frame_num='current', maintain_nondecreasing=False):
+        """Keeps the distortion of a (corrected) frame fixed and tracks the frames around it again from there
+        - the frame becomes an anchor, as are the other corrected frames and the first frame
+        - only the frames between it and the next anchor (downstream) and the previous anchor (upstream) change
+        - uses the brightness profiles from tracking if they were kept, otherwise only those frames are decoded again"""
+        # If frame_num is 'current', use the current frame number
+        if frame_num == 'current':
+            frame_num = self.current_frame_num
+        # get the frame index
+        frame_index = frame_num - self.first_frame_num
+        self.distortion_anchors.add(frame_index)
+        anchors = sorted(self.distortion_anchors | {0})
+        position = anchors.index(frame_index)
+        # The frames after it (up to the next anchor) and before it (back to the previous anchor)
+        next_anchor = anchors[position + 1] if position + 1 < len(anchors) else self.num_frames
+        prev_anchor = anchors[position - 1] if position > 0 else frame_index
+        # (positions are tracked in terms of the crop, where 1 is the top row)
+        offset = np.int32(self.crop_region[0] - 1)
+        anchor_y = int(self.distortion_y_positions[frame_index] - offset)
+        for start_idx, end_idx, backwards in [(frame_index + 1, next_anchor - 1, False), 
+                                              (prev_anchor + 1, frame_index - 1, True)]:
+            if end_idx < start_idx:
+                continue
+            if self.brightness_profiles is not None:
+                brightness = self.brightness_profiles[start_idx:end_idx + 1]
+            else:
+                _, brightness = self.track_distortion_chunk(self.crop_region, start_idx, end_idx, return_brightness=True)
+            y_positions = retrack_y_positions(brightness, anchor_y, non_decreasing=maintain_nondecreasing, backwards=backwards)
+            if maintain_nondecreasing:
+                # Don't cross the anchor at the other end of the segment
+                if backwards:
+                    y_positions = np.minimum(y_positions, self.distortion_y_positions[prev_anchor] - offset)
+                elif next_anchor < self.num_frames:
+                    y_positions = np.maximum(y_positions, self.distortion_y_positions[next_anchor] - offset)
+            self.distortion_y_positions[start_idx:end_idx + 1] = y_positions + offset
 
     def get_distortion_data_for_export(self):
         """Returns a pandas dataframe of the distortion data for export.
@@ -390,42 +724,24 @@ class Event():
             particle_tip_x, particle_tip_y, 
             particle_centre_x, particle_centre_y, particle_radius
         """
-        # Create lists to hold the data
+        # The y position of each frame
+        y_positions = np.asarray(self.distortion_y_positions)
+        num_frames = len(y_positions)
+        frame_idxs = np.arange(num_frames)
+        # Make the columns of the data (whole columns at once)
         data = {
-            'experiment_frame': [],
-            'event_frame': [],
-            'dL_pixels': [],
-            'particle_tip_x': [],
-            'particle_tip_y': [],
-            'particle_centre_x': [],
-            'particle_centre_y': [],
-            'particle_radius': []
+            # Experiment frame numbers and event frame numbers (1-based)
+            'experiment_frame': frame_idxs + self.first_frame_num,
+            'event_frame': frame_idxs + 1,
+            # dL (distance from initial position)
+            'dL_pixels': np.abs(y_positions - y_positions[0]) if num_frames > 0 else y_positions,
+            'particle_tip_x': np.full(num_frames, round(self.particle_tip_x)),
+            'particle_tip_y': y_positions,
+            'particle_centre_x': np.full(num_frames, round(self.particle_pos[0])),
+            'particle_centre_y': np.full(num_frames, round(self.particle_pos[1])),
+            'particle_radius': np.full(num_frames, round(self.particle_radius)),
         }
         
-        # For each frame in the event
-        for frame_idx in range(len(self.distortion_y_positions)):
-            # Calculate the experiment frame number
-            exp_frame = frame_idx + self.first_frame_num
-            # Calculate event frame number (1-based)
-            evt_frame = frame_idx + 1
-            
-            # Get y position for this frame
-            y_pos = self.distortion_y_positions[frame_idx]
-            
-            # Calculate dL (distance from initial position)
-            initial_y = self.distortion_y_positions[0]
-            dL = int(abs(y_pos - initial_y))
-            
-            # Add the data for this frame
-            data['experiment_frame'].append(exp_frame)
-            data['event_frame'].append(evt_frame)
-            data['dL_pixels'].append(dL)
-            data['particle_tip_x'].append(round(self.particle_tip_x))
-            data['particle_tip_y'].append(round(self.distortion_y_positions[frame_idx]))
-            data['particle_centre_x'].append(round(self.particle_pos[0]))
-            data['particle_centre_y'].append(round(self.particle_pos[1]))
-            data['particle_radius'].append(round(self.particle_radius))
-        
         # Create and return the DataFrame
         return pd.DataFrame(data)
 
@@ -448,8 +764,8 @@ class Event():
                 left_xy = (int(0), int(self.pipette_tip_centre_y + y_rise_half_width))
                 right_xy = (int(self.first_frame.shape[1]), int(self.pipette_tip_centre_y - y_rise_half_width))
                 cv2.line(frame, left_xy, right_xy, (0, 0, 255), 1)
-        # Zoom by cropping the image centred on the circle
-        if zoomed:
+        # Zoom by cropping the image centred on the circle (if there is one yet)
+        if zoomed and self.particle_pos is not None:
             # Get the centre of the circle
             centre_x = int(self.particle_pos[0])
             centre_y = int(self.particle_pos[1])
@@ -484,8 +800,8 @@ class Event():
         if frame_num < self.first_frame_num or frame_num > self.last_frame_num:
             # Raise an informative error
             raise ValueError(f"Frame number is out of range for this event. Frame number: {frame_num}, Event range: {self.first_frame_num} to {self.last_frame_num}")
-        # Grab the frame (a copy)
-        frame = get_frame(self.experiment.cap, frame_num - 1).copy()
+        # Grab the frame (a copy, as cached frames are shared)
+        frame = self.experiment.get_frame(frame_num).copy()
         # If not hidden
         if not hidden:
             # Draw the particle
@@ -625,6 +941,8 @@ class Event():
         # If the distortion is not at the top of the image
         if current_y > 1:
             new_y = current_y - 1
+            # This frame has been corrected (see retrack_distortion)
+            self.distortion_anchors.add(frame_index)
             # Move the distortion up
             self.distortion_y_positions[frame_index] = new_y
             # If maintain_nondecreasing
@@ -650,6 +968,8 @@ class Event():
         # If the distortion is not at the bottom of the image
         if current_y < self.first_frame.shape[0] - 1:
             new_y = current_y + 1
+            # This frame has been corrected (see retrack_distortion)
+            self.distortion_anchors.add(frame_index)
             # Move the distortion down
             self.distortion_y_positions[frame_index] = new_y
             # If maintain_nondecreasing
@@ -687,6 +1007,8 @@ class Event():
 class EventBox(Button):
     """event widget on the EventList scrollview widget"""
     is_selected = BooleanProperty(False)
+    # Shows the progress of the event being processed (e.g. tracked), if any
+    status = StringProperty('')
 
     def __init__(self, event, window, **kwargs):
         """init method for event boxes on a event list scrollview"""
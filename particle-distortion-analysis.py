@@ -205,6 +205,10 @@ class PDAApp(App):
     def on_current_event(self, instance, current_event):
         """Called when the current event changes.
         Calls on_current_event if the current screen has this method."""
+        # Free the decoded frames of all other events
+        for event in self.events:
+            if event is not current_event:
+                event.release_frames()
         # Get the current screen
         current_screen = self.root.current
         # If on a screen with an events list
@@ -220,6 +224,11 @@ class PDAApp(App):
         if self.current_experiment == experiment:
             # Deselect
             self.current_experiment = None
+        # Stop decoding its frames in the background
+        experiment.stop_prefetcher()
+        experiment.stop_proxy()
+        # Close its video
+        experiment.close_captures()
         # Remove from list
         self.experiments.remove(experiment)
     
@@ -63,6 +63,8 @@ class BackPopup(Popup):
                 app.root.transition.direction = "right"
             # If TD2 -> TD1
             elif self.from_screen == 'TD2' and self.to_screen == 'TD1':
+                # Stop predicting start points
+                from_screen.cancel_predictions()
                 # Clear all events, but not their boxes
                 app.clear_events(boxes_only=True)
                 # Update the from screen
@@ -76,6 +78,8 @@ class BackPopup(Popup):
                 to_screen.evt_scroll.update_is_selected()
             # If TD3 -> TD2
             elif self.from_screen == 'TD3' and self.to_screen == 'TD2':
+                # Stop tracking events
+                from_screen.cancel_tracking()
                 # Clear all events, but not their boxes
                 app.clear_events(boxes_only=True)
                 # Update the from screen
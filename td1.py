@@ -15,7 +15,7 @@ import os
 
 # Import local modules
 from popup_elements import BackPopup, ErrorPopup
-from jobs import EventBox
+from jobs import EventBox, DISK_FRAME_CACHE
 from file_management import is_experiment_json, load_experiment_json, kivify_image, open_file_dialog
 
 
@@ -111,7 +111,8 @@ class TD1Window(Screen):
                         self.app.add_experiment(experiment)
                         # Make an event objects
                         use_ion = experiment.ion_loc != None
-                        events = experiment.make_events(use_ion)
+                        # (frames are cached on disk if enabled, as these events may be revisited)
+                        events = experiment.make_events(use_ion, disk_cache=DISK_FRAME_CACHE)
                         # For every event object
                         for event in events:
                             # Add event to app list
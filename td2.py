@@ -7,17 +7,23 @@ Author: Haig Bishop (haig.bishop@pg.canterbury.ac.nz)
 # Kivy imports
 from kivy.app import App
 from kivy.uix.screenmanager import Screen
+from kivy.clock import Clock
 
 # Import modules
 import cv2
 from datetime import datetime
 import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 # Import local modules
 from popup_elements import BackPopup, ErrorPopup
 from jobs import EventBox
 from file_management import kivify_image
 
+# Number of start points predicted at the same time
+PREDICTION_WORKERS = 4
+
 
 class TD2Window(Screen):
     """Tracking Deformation screen 1"""
@@ -32,6 +38,10 @@ class TD2Window(Screen):
         self.zoomed = False
         # When True, the red circle and line is hidden
         self.hidden = False
+        # Predicts start points in the background
+        self.prediction_pool = ThreadPoolExecutor(max_workers=PREDICTION_WORKERS)
+        # Events whose start point is still being predicted (event -> future)
+        self.predicting = {}
 
     def on_track(self):
         """called by pressing the 'Track Distortion' button."""
@@ -54,7 +64,13 @@ class TD2Window(Screen):
             td3_window.load_events(track_distortion=True)
 
     def check_events(self):
-        return []
+        """Returns a list of error strings, one for each event that can't be tracked yet"""
+        evt_errors = []
+        for event in self.app.events:
+            # The start point is needed to track
+            if event in self.predicting:
+                evt_errors.append(event.name + ": start point is still being predicted\n")
+        return evt_errors
 
     def load_events(self, predict_start=True, events=None):
         """Called by previous screen when migrating events over.
@@ -71,13 +87,49 @@ class TD2Window(Screen):
         self.app.deselect_all_events()
         first_event = events[0] if len(events) > 0 else None
         self.app.select_event(first_event)
-        # Predict the start points
+        # Predict the start points (in the background, see on_prediction_done)
         if predict_start:
+            self.cancel_predictions()
             for event in events:
-                event.predict_start()
+                future = self.prediction_pool.submit(event.detect_start)
+                self.predicting[event] = future
+                future.add_done_callback(partial(self.on_prediction_done, event))
         # Update everything visually
         self.update_fields()
 
+    def on_prediction_done(self, event, future):
+        """Called (from a prediction worker thread) when a start point has been predicted or cancelled."""
+        # Apply it on the main thread
+        Clock.schedule_once(lambda dt: self.apply_prediction(event, future))
+
+    def apply_prediction(self, event, future):
+        """Updates an event with its predicted start point, as soon as it is ready."""
+        # If the prediction was cancelled (or replaced), ignore it
+        if self.predicting.get(event) is not future:
+            return
+        del self.predicting[event]
+        try:
+            event.predict_start(future.result())
+        except Exception as e:
+            # Leave the start point for the user to place
+            print("Failed to predict start point: ", e)
+        # If it is the event being shown, update it
+        if event is self.app.current_event:
+            self.update_fields()
+
+    def cancel_predictions(self):
+        """Stops predicting start points (those already running are ignored when done)."""
+        for future in self.predicting.values():
+            future.cancel()
+        self.predicting.clear()
+
+    def editable_event(self):
+        """Returns the current event, or None if there isn't one or its start point is still being predicted."""
+        current = self.app.current_event
+        if current is None or current in self.predicting:
+            return None
+        return current
+
     def on_current_event(self, instance, current_event):
         """Called when current event changes. Updates slider"""
         # Update everything visually
@@ -194,7 +246,8 @@ class TD2Window(Screen):
                 # Show overlay
                 self.hidden = False
                 self.update_image_preview()
-            elif is_arrow_key:
+            # (the start point can't be moved until it has been predicted)
+            elif is_arrow_key and current not in self.predicting:
                 if key == 'up' or key == 'w':
                     # Up key
                     if self.app.shift_is_down:
@@ -232,8 +285,8 @@ class TD2Window(Screen):
     def on_touch_move(self, touch):
         """called when there is a 'touch movement'
         - this includes things like click/drags and swipes"""
-        # If there is a current event
-        current = self.app.current_event
+        # If there is a current event (with a start point)
+        current = self.editable_event()
         if current is not None:
             # If the touch is within the image
             if self.pos_in_image(touch.pos) and not self.zoomed:
@@ -246,8 +299,8 @@ class TD2Window(Screen):
 
     def on_touch_up(self, touch):
         """this is called by all mouse up things. (e.g. left, right, middle scroll)"""
-        # If there is a current event
-        current = self.app.current_event
+        # If there is a current event (with a start point)
+        current = self.editable_event()
         if current is not None:
             # If it is a button (Kivy thing) and the touch is within the image
             if "button" in touch.profile and self.pos_in_image(touch.pos):
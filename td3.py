@@ -12,8 +12,11 @@ from kivy.clock import Clock
 
 # Import modules
 import cv2
+import numpy as np
 from datetime import datetime
 import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 # Import local modules
 from popup_elements import BackPopup, ErrorPopup, ConfirmPopup
@@ -22,6 +25,96 @@ from file_management import kivify_image
 
 # Animation duration for play to end/start (seconds)
 ANIMATION_DURATION = 1.5 
+# Number of chunks of frames tracked at the same time
+TRACKING_WORKERS = 4
+# Maximum number of frames in one chunk (long events are split into chunks tracked separately)
+TRACKING_CHUNK_FRAMES = 1000
+# Rows either side of the last position searched in each frame (None searches every row)
+# - each position then depends on the last, so the chunks of an event are tracked one after another
+TRACKING_SEARCH_WINDOW = None
+# Track the frames of each chunk a few at a time as they are decoded, instead of holding all of its crops 
+# (the same positions, see Event.track_distortion_chunk)
+STREAMING_TRACKING = True
+
+
+class TrackingJob():
+    """The distortion of one event being tracked in the background, in chunks of frames.
+    - each chunk is decoded and cropped on a worker (only the crops are kept) and gives its unsmoothed y positions
+    - with streaming, each chunk's crops are tracked a few at a time as they are decoded (only a few are held at once)
+    - with a search window, each chunk gives smoothed positions and starts from the last position of the chunk before,
+      so the next chunk is only submitted when one finishes (see Event.track_distortion_search_window)
+    - once every chunk is in, the positions are smoothed and saved to the event (see Event.finish_tracking)
+    - on_chunk_done(job, future) is called (from the worker thread) when each chunk finishes"""
+
+    def __init__(self, event, pool, on_chunk_done, search_window=None, streaming=False):
+        self.event = event
+        self.pool = pool
+        self.on_chunk_done = on_chunk_done
+        self.search_window = search_window
+        self.streaming = streaming
+        self.crop_region, self.starting_smooth_position = event.get_tracking_crop()
+        # Any old positions are out of date
+        event.distortion_y_positions = None
+        # Unsmoothed y positions and brightness profiles of every frame (filled in as chunks finish)
+        self.y_maximums = np.empty(event.num_frames, dtype=np.int32)
+        if search_window is None:
+            top_y, bottom_y = self.crop_region[:2]
+            self.brightness_profiles = np.empty((event.num_frames, bottom_y - top_y), dtype=np.float64)
+        else:
+            self.brightness_profiles = None
+        # The first and last frame of each chunk
+        self.chunk_ranges = [(start_idx, min(start_idx + TRACKING_CHUNK_FRAMES, event.num_frames) - 1)
+                             for start_idx in range(0, max(1, event.num_frames), TRACKING_CHUNK_FRAMES)]
+        # Chunks submitted (future -> index of the first frame of the chunk)
+        self.chunks = {}
+        self.num_done = 0
+        if search_window is None:
+            for start_idx, end_idx in self.chunk_ranges:
+                self.submit_chunk(start_idx, end_idx)
+        else:
+            start_idx, end_idx = self.chunk_ranges[0]
+            self.submit_chunk(start_idx, end_idx, self.starting_smooth_position)
+
+    def submit_chunk(self, start_idx, end_idx, starting_position=None):
+        """Submits a chunk of frames to be tracked on the pool."""
+        if self.search_window is None:
+            future = self.pool.submit(self.event.track_distortion_chunk, self.crop_region, start_idx, end_idx, 
+                                      return_brightness=True, streaming=self.streaming)
+        else:
+            future = self.pool.submit(self.event.track_distortion_search_window, self.crop_region, starting_position, 
+                                      self.search_window, start_idx, end_idx)
+        self.chunks[future] = start_idx
+        future.add_done_callback(partial(self.on_chunk_done, self))
+
+    def add_chunk(self, future):
+        """Adds the y positions of a finished chunk (submitting the next one if they are tracked one after another). 
+        Returns True if it was the last one."""
+        start_idx = self.chunks[future]
+        if self.search_window is None:
+            y_maximums, brightness_profiles = future.result()
+            self.brightness_profiles[start_idx:start_idx + len(y_maximums)] = brightness_profiles
+        else:
+            y_maximums = future.result()
+        self.y_maximums[start_idx:start_idx + len(y_maximums)] = y_maximums
+        self.num_done += 1
+        if self.search_window is not None and self.num_done < len(self.chunk_ranges):
+            # The next chunk starts from the last position of this one
+            next_start_idx, next_end_idx = self.chunk_ranges[self.num_done]
+            self.submit_chunk(next_start_idx, next_end_idx, int(self.y_maximums[next_start_idx - 1]))
+        return self.num_done == len(self.chunk_ranges)
+
+    def finish(self):
+        """Smooths the y positions and saves them to the event."""
+        self.event.finish_tracking(self.y_maximums, self.crop_region, self.starting_smooth_position, self.brightness_profiles)
+
+    def progress_text(self):
+        """Returns the progress as text for the event's box."""
+        return 'Tracking... ' + str(int(100 * self.num_done / len(self.chunk_ranges))) + '%'
+
+    def cancel(self):
+        """Stops the chunks which haven't started (the rest are ignored when done)."""
+        for future in self.chunks:
+            future.cancel()
 
 
 class TD3Window(Screen):
@@ -37,6 +130,10 @@ class TD3Window(Screen):
         self.zoomed = False
         # When True, the red circle and line is hidden
         self.hidden = False
+        # Tracks events in the background
+        self.tracking_pool = ThreadPoolExecutor(max_workers=TRACKING_WORKERS)
+        # Events still being tracked (event -> TrackingJob)
+        self.tracking = {}
 
     def on_confirm_export(self, update_exp_json=False):
         """called by pressing the 'Confirm and Export' button."""
@@ -138,7 +235,14 @@ class TD3Window(Screen):
                 popup.open()
 
     def check_events(self):
-        return []
+        """Returns a list of error strings, one for each event that can't be exported yet"""
+        evt_errors = []
+        for evt_box in self.evt_scroll.grid_layout.children:
+            event = evt_box.event
+            # The distortion is needed to export
+            if event in self.tracking:
+                evt_errors.append(event.name + ": distortion is still being tracked\n")
+        return evt_errors
 
     def load_events(self, track_distortion=True, events=None):
         """Called by previous screen when migrating events over.
@@ -155,13 +259,63 @@ class TD3Window(Screen):
         self.app.deselect_all_events()
         first_event = events[0] if len(events) > 0 else None
         self.app.select_event(first_event)
-        # Predict the start points
+        # Track the distortion (in the background, see on_chunk_done)
         if track_distortion:
+            self.cancel_tracking()
             for event in events:
-                event.track_distortion()
+                try:
+                    job = TrackingJob(event, self.tracking_pool, self.on_chunk_done, search_window=TRACKING_SEARCH_WINDOW, 
+                                      streaming=STREAMING_TRACKING)
+                except Exception as e:
+                    # e.g. there is no start point
+                    print("Failed to track distortion: ", e)
+                    self.set_event_status(event, 'Tracking failed')
+                    continue
+                self.tracking[event] = job
+                self.set_event_status(event, job.progress_text())
         # Update everything visually
         self.update_fields()
 
+    def on_chunk_done(self, job, future):
+        """Called (from a tracking worker thread) when a chunk of an event has been tracked or cancelled."""
+        # Add it on the main thread
+        Clock.schedule_once(lambda dt: self.add_tracked_chunk(job, future))
+
+    def add_tracked_chunk(self, job, future):
+        """Adds a tracked chunk to its event, and finishes the event when all of its chunks are in."""
+        event = job.event
+        # If the tracking was cancelled (or replaced), ignore it
+        if self.tracking.get(event) is not job:
+            return
+        try:
+            if not job.add_chunk(future):
+                # Show the progress
+                self.set_event_status(event, job.progress_text())
+                return
+            job.finish()
+            self.set_event_status(event, 'Tracked')
+        except Exception as e:
+            # The event is left without a distortion
+            print("Failed to track distortion: ", e)
+            job.cancel()
+            self.set_event_status(event, 'Tracking failed')
+        del self.tracking[event]
+        # If it is the event being shown, update it
+        if event is self.app.current_event:
+            self.update_fields()
+
+    def cancel_tracking(self):
+        """Stops tracking events."""
+        for job in self.tracking.values():
+            job.cancel()
+        self.tracking.clear()
+
+    def set_event_status(self, event, status):
+        """Shows the status (e.g. tracking progress) on the event's box."""
+        for evt_box in self.evt_scroll.grid_layout.children:
+            if evt_box.event is event:
+                evt_box.status = status
+
     def on_current_event(self, instance, current_event):
         """Called when current event changes. Updates slider"""
         # Update everything visually
@@ -280,8 +434,16 @@ class TD3Window(Screen):
                 # Show overlay
                 self.hidden = False
                 self.update_image_preview()
+            # If the 'r' key is released (and the distortion has been tracked)
+            elif key == "r" and current.distortion_y_positions is not None:
+                # Track the distortion again from this frame (keeping the corrected frames)
+                current.retrack_distortion(maintain_nondecreasing=self.maintain_nondecreasing_checkbox.active)
+                self.update_image_preview()
             elif is_arrow_key:
-                if key == 'up' or key == 'w':
+                # (the distortion can't be moved until it has been tracked)
+                if current.distortion_y_positions is None and key in ['up', 'w', 'down', 's']:
+                    pass
+                elif key == 'up' or key == 'w':
                     # Up key
                     current.move_distortion_up(maintain_nondecreasing=self.maintain_nondecreasing_checkbox.active)
                 elif key == 'down' or key == 's':
@@ -0,0 +1,77 @@
+"""
+Tests for the distortion tracking and contrast functions in tracking.py
+Run with: python -m pytest -q
+"""
+
+import cv2
+import numpy as np
+import pytest
+
+from tracking import get_y_maximum_single_frame_crop, get_y_maximums_frame_stack, calculate_alpha_beta, calculate_alpha_beta_stack
+
+
+def reference_brightness(image):
+    """The weighted brightness of each row, as the original (per-pixel weights array) get_y_maximum_single_frame_crop."""
+    if len(image.shape) == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    image = cv2.normalize(image, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+    image = 255 - image
+    height, width = image.shape
+    weights = np.zeros((height, width))
+    for x, x_idx in zip(np.linspace(-1, 1, width), range(width)):
+        weights[:, x_idx] = -0.5*x**2 + 1
+    return np.sum(image.copy() * weights, axis=1)
+
+def reference_y_maximum(image):
+    """The original version of get_y_maximum_single_frame_crop."""
+    return np.argmax(reference_brightness(image)) + 1
+
+def near_tie_crop(height, width, seed):
+    """A crop where many rows have (almost) the same brightness."""
+    rng = np.random.default_rng(seed)
+    row = rng.integers(0, 256, width, dtype=np.uint8)
+    image = np.tile(row, (height, 1))
+    # Nudge a few pixels of a few rows by 1
+    for y in rng.integers(0, height, 3):
+        image[y, rng.integers(0, width)] ^= 1
+    return np.dstack([image] * 3)
+
+
+@pytest.mark.parametrize("width", [2, 7, 16, 33, 64, 101])
+def test_single_frame_uniform_crop_is_top_row(width):
+    image = np.full((60, width, 3), 100, dtype=np.uint8)
+    assert get_y_maximum_single_frame_crop(image) == 1
+
+@pytest.mark.parametrize("seed", range(20))
+def test_single_frame_near_tie_matches_reference(seed):
+    image = near_tie_crop(50, 5 + 7 * seed, seed)
+    assert get_y_maximum_single_frame_crop(image) == reference_y_maximum(image)
+
+def test_frame_stack_matches_single_frame_on_ties():
+    crops = [near_tie_crop(50, 33, seed) for seed in range(40)]
+    crops.append(np.full((50, 33, 3), 100, dtype=np.uint8))
+    expected = [get_y_maximum_single_frame_crop(crop) for crop in crops]
+    assert get_y_maximums_frame_stack(np.stack(crops)).tolist() == expected
+
+def test_frame_stack_matches_single_frame_on_random_crops():
+    rng = np.random.default_rng(0)
+    # Narrow ranges of values as well as full ones (the normalisation rounds differently)
+    crops = [rng.integers(low, low + span, (40, 12, 3), dtype=np.uint8) 
+             for low, span in zip(rng.integers(0, 150, 300), rng.integers(2, 100, 300))]
+    expected = [get_y_maximum_single_frame_crop(crop) for crop in crops]
+    y_maximums, brightness = get_y_maximums_frame_stack(np.stack(crops), return_brightness=True)
+    assert y_maximums.tolist() == expected
+    # (the row scores themselves are identical, not just the winning rows)
+    assert np.array_equal(brightness, np.stack([reference_brightness(crop) for crop in crops]))
+
+@pytest.mark.parametrize("shape", [(30, 40, 3), (30, 40), (300, 400, 3)])
+def test_alpha_beta_stack_matches_single_frame(shape):
+    rng = np.random.default_rng(0)
+    # More frames than one batch, with different ranges of grays (small frames are counted in batches, large ones aren't)
+    frames = np.stack([rng.integers(low, low + span, shape, dtype=np.uint8) 
+                       for low, span in zip(rng.integers(0, 150, 40), rng.integers(20, 100, 40))])
+    alphas, betas = calculate_alpha_beta_stack(frames)
+    for frame, alpha, beta in zip(frames, alphas, betas):
+        if frame.ndim == 2:
+            frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+        assert (alpha, beta) == calculate_alpha_beta(frame)
@@ -6,25 +6,203 @@ Author: Haig Bishop (haig.bishop@pg.canterbury.ac.nz)
 
 import cv2
 import numpy as np
-
-
-
-
-def get_y_maximums_multiple_frame_crops(images, smooth=False, non_decreasing=False, starting_smooth_position=None, display=False):
-    """Takes a list of images and returns a list of y positions.
-    - if smooth is true, the y positions are smoothed simply by only allowing the y position to move up or down by 1 pixel."""
-    y_maximums = []
-    for image in images:
-        y_maximums.append(get_y_maximum_single_frame_crop(image, display=display))
-    if smooth:
+from functools import lru_cache
+
+
+
+
+# Number of frames processed at once by get_y_maximums_frame_stack (bounds its temporary memory)
+TRACKING_BATCH_SIZE = 512
+# Number of crops held at once when tracking them as they are decoded (see iter_frame_batches)
+STREAMING_BATCH_SIZE = 32
+# Number of frames whose histograms calculate_alpha_beta_stack counts at once (bounds its temporary memory)
+CONTRAST_BATCH_SIZE = 16
+# Largest frame (in pixels) whose histogram is counted in a batch, larger frames are quicker one at a time with calcHist
+CONTRAST_BATCH_MAX_PIXELS = 256 * 256
+# Range of the number of frames smooth_y_positions looks ahead at once
+SMOOTHING_MIN_WINDOW = 64
+SMOOTHING_MAX_WINDOW = 4096
+# Runs shorter than this are smoothed frame by frame (faster than finding many tiny runs)
+SMOOTHING_SHORT_RUN = 32
+# Number of rows either side of the last position searched by get_y_positions_search_window
+SEARCH_WINDOW_ROWS = 8
+# Smallest difference (in grey levels) between the darkest and brightest rows of a search window to trust it
+SEARCH_WINDOW_MIN_CONTRAST = 2
+# Size (in pixels, each way) of the copy of the pipette used to check if it has moved
+PIPETTE_REFERENCE_SIZE = 32
+# Mean change in brightness (0-255) of that copy at which the pipette is detected again
+PIPETTE_MOVED_THRESHOLD = 6
+# Largest size (in pixels, each way) the pipette is first searched for at by detect_sides_coarse_to_fine
+COARSE_DETECTION_SIZE = 512
+# Smallest image (in pixels, its longest side) searched coarse to fine, smaller images are searched at full resolution
+COARSE_TO_FINE_MIN_SIZE = 2048
+# Smallest margin (in pixels) around the pipette when it is searched for again at full resolution
+COARSE_ROI_MARGIN = 32
+
+
+def get_y_maximums_frame_stack(frames, smooth=False, non_decreasing=False, starting_smooth_position=None, return_brightness=False):
+    """Takes a stack of crops and returns an array of the y position of the distortion in each.
+    - frames is one array of shape (N, H, W, 3) (BGR) or (N, H, W) (greyscale)
+    - does exactly the same as get_y_maximum_single_frame_crop to every frame (same normalisation and row sums,
+      so the same row wins ties), but with whole-array operations
+    - returns an array of the N y positions (1 is the top row of the crops)
+    - if return_brightness is True, also returns the (N, H) float64 array of the weighted brightness of every row 
+      (the y position is the brightest, used by retrack_y_positions)"""
+    frames = np.ascontiguousarray(frames)
+    num_frames, height, width = frames.shape[:3]
+    weights = column_weights(width)
+    y_maximums = np.empty(num_frames, dtype=np.int32)
+    if return_brightness:
+        all_brightness = np.empty((num_frames, height), dtype=np.float64)
+    # In batches (so the float copies of the frames stay small)
+    for start in range(0, num_frames, TRACKING_BATCH_SIZE):
+        batch = frames[start:start + TRACKING_BATCH_SIZE]
+        # Reduce to greyscale (all frames as one tall image, so it is one call)
+        if batch.ndim == 4:
+            batch = cv2.cvtColor(batch.reshape(-1, width, 3), cv2.COLOR_BGR2GRAY).reshape(-1, height, width)
+        # Normalise each frame to 0-255 and invert it
+        # (with cv2.normalize itself, as its rounding is hard to match exactly, it is cheap for a crop)
+        inverted = np.empty(batch.shape, dtype=np.uint8)
+        for i, frame in enumerate(batch):
+            cv2.normalize(frame, inverted[i], 0, 255, cv2.NORM_MINMAX)
+        np.subtract(255, inverted, out=inverted)
+        # Weigh the columns and find the brightest row of each frame
+        # (summed along each row like get_y_maximum_single_frame_crop, so the row sums are identical)
+        brightness = (inverted * weights).sum(axis=2)
+        y_maximums[start:start + len(batch)] = np.argmax(brightness, axis=1) + 1
+        if return_brightness:
+            all_brightness[start:start + len(batch)] = brightness
+    if smooth and num_frames > 0:
         if starting_smooth_position is None:
             starting_smooth_position = y_maximums[0]
         y_maximums = smooth_y_positions(y_maximums, starting_smooth_position)
-
     if non_decreasing:
         y_maximums = non_decreasing_y_positions(y_maximums)
+    y_maximums = y_maximums.astype(np.int32, copy=False)
+    if return_brightness:
+        return y_maximums, all_brightness
     return y_maximums
 
+def retrack_y_positions(brightness, anchor_y, non_decreasing=True, backwards=False):
+    """Tracks a segment of frames again from a fixed (e.g. corrected) position next to it.
+    - brightness is the (N, H) weighted brightness of the rows of the segment's crops (see get_y_maximums_frame_stack)
+    - anchor_y is the position of the frame just before the segment (or just after it, if backwards)
+    - the positions are smoothed starting from the anchor, and if non_decreasing they stay non-decreasing with it
+      (backwards, the segment is tracked from its last frame to its first)
+    - returns an int32 array of the N y positions (1 is the top row of the crops)"""
+    y_maximums = np.argmax(brightness, axis=1).astype(np.int32) + 1
+    if backwards:
+        y_maximums = y_maximums[::-1]
+    # Smooth with the anchor as the starting position (then leave it out)
+    y_positions = smooth_y_positions(np.concatenate(([anchor_y], y_maximums)), anchor_y)
+    if non_decreasing:
+        # (backwards, each frame is the highest of itself and the frames after it)
+        y_positions = np.maximum.accumulate(y_positions) if backwards else non_decreasing_y_positions(y_positions)
+    y_positions = y_positions[1:]
+    if backwards:
+        y_positions = y_positions[::-1]
+    return y_positions.astype(np.int32, copy=False)
+
+def iter_tracked_y_positions(frames, starting_smooth_position, search_window=None):
+    """Streaming version of tracking the distortion: crops -> y maximums -> smoothing -> non-decreasing
+    - frames is any iterable of crops, e.g. a generator of them as they are decoded
+    - yields the y position of each frame (1 is the top row of the crops) as soon as it is known,
+      and only holds a small batch of crops at once (none if search_window is given)
+    - the same positions as get_y_maximums_frame_stack with smooth=True and non_decreasing=True
+      (or get_y_positions_search_window if search_window is given)"""
+    if search_window is None:
+        y_positions = iter_smoothed_y_positions(iter_y_maximums(frames), starting_smooth_position)
+    else:
+        y_positions = iter_y_positions_search_window(frames, starting_smooth_position, window=search_window)
+    return iter_non_decreasing_y_positions(y_positions)
+
+def iter_y_maximums(frames, batch_size=STREAMING_BATCH_SIZE):
+    """Generator version of get_y_maximums_frame_stack (without smoothing) for any iterable of crops.
+    - crops are taken in batches of at most batch_size, so only that many are held at once"""
+    for batch in iter_frame_batches(frames, batch_size):
+        yield from get_y_maximums_frame_stack(batch).tolist()
+
+def iter_frame_batches(frames, batch_size=STREAMING_BATCH_SIZE):
+    """Yields the crops of any iterable of them as stacks of at most batch_size (the last may be shorter)."""
+    batch = []
+    for frame in frames:
+        batch.append(frame)
+        if len(batch) == batch_size:
+            yield np.stack(batch)
+            batch = []
+    if batch:
+        yield np.stack(batch)
+
+def iter_smoothed_y_positions(y_positions, starting_smooth_position):
+    """Generator version of smooth_y_positions for any iterable of y positions."""
+    current_y = None
+    for y in y_positions:
+        # Start at the starting position, then move towards each position by (at most) 1 pixel
+        if current_y is None:
+            current_y = int(starting_smooth_position)
+        else:
+            current_y += (y > current_y) - (y < current_y)
+        yield current_y
+
+def iter_non_decreasing_y_positions(y_positions):
+    """Generator version of non_decreasing_y_positions for any iterable of y positions."""
+    lowest_y = None
+    for y in y_positions:
+        lowest_y = y if lowest_y is None else min(lowest_y, y)
+        yield lowest_y
+
+def get_y_positions_search_window(frames, starting_smooth_position, window=SEARCH_WINDOW_ROWS):
+    """Returns an int32 array of the positions from iter_y_positions_search_window."""
+    return np.fromiter(iter_y_positions_search_window(frames, starting_smooth_position, window=window), dtype=np.int32)
+
+def iter_y_positions_search_window(frames, starting_smooth_position, window=SEARCH_WINDOW_ROWS):
+    """Does the same as get_y_maximums_frame_stack with smooth=True (but not non_decreasing), 
+    but only looks at the rows near the last position in each frame.
+    - frames is any iterable of crops (BGR or greyscale), e.g. a stack or a generator
+    - the smoothed position only moves towards the brightest row (of the inverted crop) by 1 pixel per frame, 
+      so only whether that row is above or below matters, which can be seen from a few rows either side
+    - the whole crop is searched instead if the brightest row of the window is at its edge, 
+      or the window has too little contrast to trust
+    - yields the smoothed y position of each frame (1 is the top row of the crops)"""
+    current_y = int(starting_smooth_position)
+    for i, frame in enumerate(frames):
+        # The first position is the starting position
+        if i == 0:
+            yield current_y
+            continue
+        if frame.ndim == 3:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        height, width = frame.shape
+        weights = column_weights(width)
+        # Rows within the window of the last position (which is 1-based)
+        top = min(max(0, current_y - 1 - window), height - 1)
+        bottom = min(height, current_y + window)
+        # Normalising and inverting the crop doesn't change the order of the rows, so the brightest row 
+        # of the inverted crop is the darkest weighted row
+        # (summed the same way as get_y_maximum_single_frame_crop, so ties go to the top row)
+        row_sums = (frame[top:bottom] * weights).sum(axis=1)
+        darkest = int(np.argmin(row_sums))
+        at_edge = (darkest == 0 and top > 0) or (darkest == len(row_sums) - 1 and bottom < height)
+        low_contrast = row_sums[darkest] > np.max(row_sums) - SEARCH_WINDOW_MIN_CONTRAST * weights.sum()
+        if at_edge or low_contrast:
+            # Search the whole crop
+            top = 0
+            darkest = int(np.argmin((frame * weights).sum(axis=1)))
+        y = top + darkest + 1
+        # Move towards it by (at most) 1 pixel
+        current_y += (y > current_y) - (y < current_y)
+        yield current_y
+
+@lru_cache(maxsize=None)
+def column_weights(width):
+    """Returns the parabolic column weights used by get_y_maximum_single_frame_crop for crops of this width.
+    - [y = -0.5x**2 + 1] where x goes from -1 to 1 across the columns
+    - cached (all crops of an event have the same width), so the array is read-only"""
+    x = np.linspace(-1, 1, width)
+    weights = -0.5 * x**2 + 1
+    weights.flags.writeable = False
+    return weights
+
 def get_y_maximum_single_frame_crop(image, display=False):
     """Takes one frame cropped at the top of the particle. 
     - Purpose is to identify what y position the distortion gets to.
@@ -40,23 +218,19 @@ def get_y_maximum_single_frame_crop(image, display=False):
         image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
     
     # Invert the image (fixed to avoid overflow)
-    image = cv2.normalize(image, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
-    image = 255 - image  # This is the safer way to invert uint8 images
+    image = cv2.normalize(image, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8, copy=False)
+    image = np.subtract(255, image, out=image)  # This is the safer way to invert uint8 images (in place, it is our own copy)
     
     # Get the image dimensions
     height, width = image.shape
-    # Create a new array to store the weights
-    weights = np.zeros((height, width))
-    # Iterate through each column
-    for x, x_idx in zip(np.linspace(-1, 1, width), range(width)):
-        # Calculate the weight for this column
-        weight = -0.5*x**2 + 1
-        # Add the weight to the array
-        weights[:, x_idx] = weight
+    # Get the weight of each column (the same for every row, and every crop of this width)
+    weights = column_weights(width)
     # Apply the weights to the image
-    weighted_image = image.copy() * weights
+    weighted_image = image * weights
     # Calculate the brightness of each row
-    brightness = np.sum(weighted_image, axis=1)
+    # (summed along each row rather than with a matrix-vector product, so identical rows get identical
+    # brightness and ties go to the top row)
+    brightness = weighted_image.sum(axis=1)
     # Find the y position of the maximum brightness
     y_max = np.argmax(brightness)
     
@@ -80,40 +254,70 @@ def get_y_maximum_single_frame_crop(image, display=False):
     return y_max + 1
 
 def smooth_y_positions(y_positions, starting_smooth_position):
-    """Takes a list of y positions and returns a list of y positions.
-    - if smooth is true, the y positions are smoothed simply by only allowing the y position to move up or down by 1 pixel."""
-    smoothed_y_positions = []
-    for i in range(len(y_positions)):
-        # If this is the first position
-        if i == 0:
-            # Set the starting position
-            smoothed_y_positions.append(starting_smooth_position)
+    """Takes an array (or list) of y positions and returns an int32 array of smoothed y positions.
+    - the y positions are smoothed simply by only allowing the y position to move up or down by 1 pixel
+      each frame (towards the unsmoothed position), starting at starting_smooth_position
+    - each step depends on the last, so it is done in runs of frames which can be filled in at once:
+        - 'following' runs, while the position is within 1 pixel of the last one it is simply copied
+        - 'ramp' runs, while the position stays above (or below, or equal to) the smoothed one,
+          the smoothed position moves by 1 pixel (or 0) every frame"""
+    y_positions = np.asarray(y_positions, dtype=np.int32)
+    num_positions = len(y_positions)
+    smoothed_y_positions = np.empty(num_positions, dtype=np.int32)
+    if num_positions == 0:
+        return smoothed_y_positions
+    # Set the starting position
+    smoothed_y_positions[0] = starting_smooth_position
+    current_y = int(starting_smooth_position)
+    # Number of frames to look ahead for the end of a run (grows while runs are long)
+    window = SMOOTHING_MIN_WINDOW
+    # Number of frames to step through one at a time when runs are short (grows while they stay short)
+    block_size = SMOOTHING_MIN_WINDOW
+    i = 1
+    while i < num_positions:
+        chunk = y_positions[i:i + window]
+        # If the position is within 1 pixel, follow it until it jumps by more than 1 pixel
+        if abs(int(chunk[0]) - current_y) <= 1:
+            jumps = np.flatnonzero(np.abs(np.diff(chunk)) > 1)
+            run_length = jumps[0] + 1 if len(jumps) > 0 else len(chunk)
+            smoothed_y_positions[i:i + run_length] = chunk[:run_length]
+        # Otherwise move towards it by 1 pixel per frame until it is no longer in that direction
+        else:
+            direction = 1 if chunk[0] > current_y else -1
+            steps = np.arange(1, len(chunk) + 1, dtype=np.int32)
+            # The smoothed position before each frame of the ramp
+            previous_y = current_y + direction * (steps - 1)
+            breaks = np.flatnonzero(np.sign(chunk - previous_y) != direction)
+            run_length = breaks[0] if len(breaks) > 0 else len(chunk)
+            smoothed_y_positions[i:i + run_length] = current_y + direction * steps[:run_length]
+        current_y = int(smoothed_y_positions[i + run_length - 1])
+        i += run_length
+        # Look further ahead if the whole chunk was one run
+        window = min(window * 2, SMOOTHING_MAX_WINDOW) if run_length == len(chunk) else SMOOTHING_MIN_WINDOW
+        # If runs are short here (noisy positions), step through the next frames one at a time instead
+        # (for longer and longer blocks while they stay short)
+        if run_length < min(SMOOTHING_SHORT_RUN, len(chunk)):
+            block_end = min(i + block_size, num_positions)
+            block = []
+            for y in y_positions[i:block_end].tolist():
+                # Move towards the position by (at most) 1 pixel
+                current_y += (y > current_y) - (y < current_y)
+                block.append(current_y)
+            smoothed_y_positions[i:block_end] = block
+            i = block_end
+            block_size = min(block_size * 2, SMOOTHING_MAX_WINDOW)
         else:
-            # If the position is equal to the previous position, keep it
-            if y_positions[i] == smoothed_y_positions[-1]:
-                smoothed_y_positions.append(y_positions[i])
-            # If the position is greater than the previous position, move it up by 1 pixel
-            elif y_positions[i] > smoothed_y_positions[-1]:
-                smoothed_y_positions.append(smoothed_y_positions[-1] + 1)
-            # If the position is less than the previous position, move it down by 1 pixel
-            else:
-                smoothed_y_positions.append(smoothed_y_positions[-1] - 1)
+            block_size = SMOOTHING_MIN_WINDOW
     return smoothed_y_positions
 
 def non_decreasing_y_positions(y_positions):
-    """Takes a list of y positions and returns a list where each value is at least
+    """Takes an array (or list) of y positions and returns an array where each value is at least
     as large as the previous value. If a value is lower than the previous, it is
     set equal to the previous value.
     
     IMPORTANT: the Y-axis is inverted in the cropped images, so this function
-    actually makes the y-positions non-increasing."""
-    result = y_positions.copy()  # Create a copy to avoid modifying the input
-    for i in range(1, len(result)):
-        # If current value is greater than previous (remember y-axis is inverted)
-        # we set it equal to the previous value to maintain non-increasing sequence
-        if result[i] > result[i-1]:
-            result[i] = result[i-1]
-    return result
+    actually makes the y-positions non-increasing (a cumulative minimum)."""
+    return np.minimum.accumulate(np.asarray(y_positions))
 
 def filter_circles_bbox(circles, bbox):
     """takes a list of circles (x, y, r) and a bounding box [x, y, x2, y2]'
@@ -124,18 +328,13 @@ def filter_circles_bbox(circles, bbox):
     if circles is not None:
         # Get the x, y coordinates of the bounding box
         x1, y1, x2, y2 = bbox
-        # Create a new array to store the circles that are within the bounding box
-        new_circles = np.empty((0, 3), dtype=np.int32)
-        # Iterate through all detected circles
-        for circle in circles[0]:
-            # Get the coordinates of the circle
-            center_x, center_y, radius = circle[0], circle[1], circle[2]
-            left_x, right_x = center_x - radius, center_x + radius
-            bottom_y, top_y = center_y - radius, center_y + radius
-            # Check if the center of the circle is within the bounding box
-            if x1 < left_x and right_x < x2 and y1 < bottom_y and top_y < y2:
-                # The center of the circle is inside the bounding box, keep it
-                new_circles = np.vstack([new_circles, circle])
+        # Get the coordinates of all circles
+        center_x, center_y, radius = circles[0, :, 0], circles[0, :, 1], circles[0, :, 2]
+        left_x, right_x = center_x - radius, center_x + radius
+        bottom_y, top_y = center_y - radius, center_y + radius
+        # Keep the circles which are within the bounding box
+        inside = (x1 < left_x) & (right_x < x2) & (y1 < bottom_y) & (top_y < y2)
+        new_circles = circles[0][inside]
         # Reshape the array to shape (1, N, 3)
         circles = new_circles.reshape((1, new_circles.shape[0], new_circles.shape[1]))
         # If the circles are empty
@@ -163,32 +362,50 @@ def get_best_circle(circles, expected_radius, expected_x):
     return circle
 
 
-def bounded_hough_circle(image, bbox, min_r, max_r, expected_radius, display=False):
+def hough_threshold_schedule(thres_1=150, thres_2=75, decay=0.85, num_steps=28):
+    """Returns the (param1, param2) thresholds bounded_hough_circle tries, from strictest to most lenient
+    - each step the thresholds are decreased (by the decay), but stay positive
+    - once they bottom out they repeat, repeats are left out (they would find the same circles)"""
+    schedule = []
+    for _ in range(num_steps):
+        thres_1 = max(1, int(thres_1))
+        thres_2 = max(1, int(thres_2))
+        if (thres_1, thres_2) not in schedule:
+            schedule.append((thres_1, thres_2))
+        thres_1 = int(thres_1 * decay)
+        thres_2 = int(thres_2 * decay)
+    return schedule
+
+# The thresholds tried by bounded_hough_circle
+HOUGH_THRESHOLDS = hough_threshold_schedule()
+# Extra pixels around the region searched for circles (so edges at the sides of the region are found the same)
+HOUGH_ROI_MARGIN = 4
+
+
+def bounded_hough_circle(image, bbox, min_r, max_r, expected_radius, display=False, fallback=True):
     """takes an image, a bounding box, a min radius and a max radius
     - preforms hough transform iteratively until a circle is found
-    - maximum # Iterations is 28
-    - if no circles are found, an 'expected' circle is returned
-    - each iteration the thresholds are decreased
-    - the circles must be within the bbox
+    - each iteration the thresholds are decreased (see HOUGH_THRESHOLDS)
+    - if no circles are found, an 'expected' circle is returned (or None if fallback is False)
+    - the circles must be within the bbox, so only the region around the bbox is searched
     - after Hough returns 1 or more circles, the 'best' one is picked"""
-    # Define starting thresholds
-    thres_1 = 150
-    thres_2 = 75
+    # Define the expected circle in order to select the best one
+    expected_x = int((bbox[0] + bbox[2]) / 2)
+    expected_y = int((bbox[1] + bbox[3]) / 2)
+    # Returned if no circle is found
+    expected_circle = (expected_x, expected_y, expected_radius) if fallback else None
 
     # Input validation to prevent OpenCV errors
     if min_r <= 0 or max_r <= 0:
         print("Invalid radius values")
-        return (expected_x, expected_y, expected_radius)
+        return expected_circle
     
     if min_r >= max_r:
         print("Min radius must be less than max radius")
-        return (expected_x, expected_y, expected_radius)
+        return expected_circle
 
     # The minimum distance between circles
     min_dist = 1
-    # Define the expected circle in order to select the best one
-    expected_x = int((bbox[0] + bbox[2]) / 2)
-    expected_y = int((bbox[1] + bbox[3]) / 2)
         
     if display:
         disp_img = image.copy()
@@ -199,30 +416,33 @@ def bounded_hough_circle(image, bbox, min_r, max_r, expected_radius, display=Fal
         cv2.imshow('Expected & Min/Max Circles', disp_img)
         cv2.waitKey(0)
 
-    # Loop until you find a circle or pass 28 iterations
-    circles = None
-    i = 0
-    while circles is None and i < 28:
-        i += 1
-        # Ensure thresholds stay positive
-        thres_1 = max(1, int(thres_1))
-        thres_2 = max(1, int(thres_2))
-        
-        try:
-            # Attempt to detect circles in the grayscale image.
-            circles = cv2.HoughCircles(
-                image,
-                cv2.HOUGH_GRADIENT,
-                1,
-                min_dist,
-                param1=thres_1,
-                param2=thres_2,
-                minRadius=min_r,
-                maxRadius=max_r,
-            )
-        except cv2.error as e:
-            print(f"OpenCV error: {e}")
-            return (expected_x, expected_y, expected_radius)
+    # Crop to the bbox, plus the edges that can vote for circle centres inside of it (up to max_r away)
+    height, width = image.shape[:2]
+    pad = max_r + HOUGH_ROI_MARGIN
+    roi_x = min(max(0, int(bbox[0]) - pad), width)
+    roi_y = min(max(0, int(bbox[1]) - pad), height)
+    roi_x2 = max(roi_x, min(width, int(bbox[2]) + pad))
+    roi_y2 = max(roi_y, min(height, int(bbox[3]) + pad))
+    roi = image[roi_y:roi_y2, roi_x:roi_x2]
+
+    def find_circles(thresholds):
+        """Returns the circles inside the bbox found with these thresholds (or None)"""
+        thres_1, thres_2 = thresholds
+        # Attempt to detect circles in the grayscale image.
+        circles = cv2.HoughCircles(
+            roi,
+            cv2.HOUGH_GRADIENT,
+            1,
+            min_dist,
+            param1=thres_1,
+            param2=thres_2,
+            minRadius=min_r,
+            maxRadius=max_r,
+        )
+        # Move them back into the coordinates of the whole image
+        if circles is not None:
+            circles[0, :, 0] += roi_x
+            circles[0, :, 1] += roi_y
 
         if display and circles is not None:
             disp_img = image.copy()
@@ -232,9 +452,6 @@ def bounded_hough_circle(image, bbox, min_r, max_r, expected_radius, display=Fal
                 cv2.circle(disp_img, center, radius, (0, 255, 0), 1)
             cv2.imshow('Circles 1', disp_img)
             cv2.waitKey(0)
-        elif display:
-            # print('no circles 1')
-            pass
 
         # Filter circles outside of bbox
         circles = filter_circles_bbox(circles, bbox)
@@ -247,13 +464,22 @@ def bounded_hough_circle(image, bbox, min_r, max_r, expected_radius, display=Fal
                 cv2.circle(disp_img, center, radius, (0, 255, 0), 1)  # Draw the circle on the disp_img
             cv2.imshow('Circles 2', disp_img)
             cv2.waitKey(0)
-        elif display:
-            # print('no circles 2')
-            pass
+        return circles
+
+    try:
+        # Loop until you find a circle or run out of thresholds
+        # (strictest first, the detector gets much slower as the thresholds get lower)
+        circles = None
+        for thresholds in HOUGH_THRESHOLDS:
+            if roi.size == 0:
+                break
+            circles = find_circles(thresholds)
+            if circles is not None:
+                break
+    except cv2.error as e:
+        print(f"OpenCV error: {e}")
+        return expected_circle
 
-        # Increase thresholds
-        thres_1 = int(thres_1 * 0.85)
-        thres_2 = int(thres_2 * 0.85)
     # Format circles (all ints and remvove packet)
     if not circles is None:
         # Remove packet shell thing
@@ -267,9 +493,9 @@ def bounded_hough_circle(image, bbox, min_r, max_r, expected_radius, display=Fal
     else:
         # Make up circle of expected size and pos
         print("NO CIRCLE FOUND")
-        circle = (expected_x, expected_y, expected_radius)
+        circle = expected_circle
         
-    if display:
+    if display and circle is not None:
         disp_img = image.copy()
         center = (int(circle[0]), int(circle[1]))
         radius = int(circle[2])
@@ -284,36 +510,110 @@ def calculate_alpha_beta(image):
     - returns alpha and beta values to optimally fix contrast/brightness"""
     # Automatic brightness and contrast optimisation with optional histogram clipping
     gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    clip_hist_percent = 1
     # Calculate grayscale histogram
     hist = cv2.calcHist([gray], [0], None, [256], [0, 256])
-    hist_size = len(hist)
-    # Calculate cumulative distribution from the histogram
-    accumulator = []
-    accumulator.append(float(hist[0][0]))
-    for index in range(1, hist_size):
-        accumulator.append(accumulator[index - 1] + float(hist[index][0]))
     # Locate points to clip
-    maximum = accumulator[-1]
-    clip_hist_percent *= maximum / 100.0
-    clip_hist_percent /= 2.0
-    # Locate left cut
-    minimum_gray = 0
-    while accumulator[minimum_gray] < clip_hist_percent:
-        minimum_gray += 1
-    # Locate right cut
-    maximum_gray = hist_size - 1
-    while (
-        accumulator[maximum_gray] >= (maximum - clip_hist_percent) and maximum_gray > 10
-    ):
-        maximum_gray -= 1
+    minimum_grays, maximum_grays = histogram_clip_points(hist.reshape(1, -1))
+    minimum_gray, maximum_gray = int(minimum_grays[0]), int(maximum_grays[0])
     # Calculate alpha and beta values
     alpha = 255 / (maximum_gray - minimum_gray)
     beta = -minimum_gray * alpha
     return alpha, beta
 
-def detect_sides(image, display=False):
-    """In the image it will predict the pipette position, angle and bottom"""
+def calculate_alpha_beta_stack(frames):
+    """Batched version of calculate_alpha_beta for a stack of frames (e.g. to normalise the contrast of a whole event).
+    - frames is one array of shape (N, H, W, 3) (BGR) or (N, H, W) (greyscale), or a list of frames
+    - returns arrays of the N alpha and beta values, the same as calculate_alpha_beta for each frame
+      (alpha is inf if a frame has no contrast)"""
+    frames = np.asarray(frames)
+    num_frames, height, width = frames.shape[:3]
+    hists = np.empty((num_frames, 256), dtype=np.int64)
+    # In batches (so the temporary arrays stay small)
+    for start in range(0, num_frames, CONTRAST_BATCH_SIZE):
+        batch = frames[start:start + CONTRAST_BATCH_SIZE]
+        # Reduce to greyscale (all frames as one tall image, so it is one call)
+        if batch.ndim == 4:
+            batch = cv2.cvtColor(np.ascontiguousarray(batch).reshape(-1, width, 3), cv2.COLOR_BGR2GRAY).reshape(-1, height, width)
+        # (for large frames the per-frame overhead doesn't matter, and calcHist is much quicker than counting with numpy)
+        if height * width > CONTRAST_BATCH_MAX_PIXELS:
+            for i, gray in enumerate(batch):
+                hists[start + i] = cv2.calcHist([gray], [0], None, [256], [0, 256]).ravel()
+            continue
+        # Count the grays of every frame at once (frame i's grays are counted in bins i*256 to i*256 + 255)
+        # (uint16 is big enough for CONTRAST_BATCH_SIZE frames and quicker than the default int64)
+        offsets = (np.arange(len(batch), dtype=np.uint16) * 256)[:, None, None]
+        counts = np.bincount((batch.astype(np.uint16) + offsets).ravel(), minlength=len(batch) * 256)
+        hists[start:start + len(batch)] = counts.reshape(-1, 256)
+    # Locate points to clip (for all frames at once)
+    minimum_grays, maximum_grays = histogram_clip_points(hists)
+    # Calculate alpha and beta values
+    with np.errstate(divide='ignore'):
+        alphas = 255 / (maximum_grays - minimum_grays)
+    betas = -minimum_grays * alphas
+    return alphas, betas
+
+def histogram_clip_points(hists):
+    """Takes an array of (N, 256) grayscale histograms, returns arrays of the N minimum and maximum grays to stretch to 0-255
+    - clips 1% of the pixels (half from each end), the maximum gray is always above 10"""
+    clip_hist_percent = 1
+    # Calculate cumulative distribution from the histograms
+    accumulators = np.cumsum(hists, axis=1, dtype=np.float64)
+    # Locate points to clip
+    maximums = accumulators[:, -1]
+    clips = clip_hist_percent * maximums / 100.0
+    clips /= 2.0
+    # Locate left cut (the first gray the cumulative distribution reaches the clip at)
+    # (the distributions are sorted, so counting the values below is the same as a sorted search)
+    minimum_grays = np.count_nonzero(accumulators < clips[:, None], axis=1)
+    # Locate right cut (the last gray the cumulative distribution is still below the top clip at)
+    maximum_grays = np.count_nonzero(accumulators < (maximums - clips)[:, None], axis=1) - 1
+    maximum_grays = np.maximum(maximum_grays, 10)
+    return minimum_grays, maximum_grays
+
+def get_line_features(hough_lines, min_length):
+    """Takes the lines from HoughLinesP and returns an array of the features of each line, one row per line:
+    (gradient, x0, bottom_x, bottom_y, length)
+    - gradient is dx/dy and x0 is the x position where the line meets the top of the image (y=0)
+    - lines no longer than min_length are discarded, and horizontal lines (not pipette sides and cause divide-by-zero)"""
+    x1, y1, x2, y2 = hough_lines.reshape(-1, 4).T
+    lengths = np.sqrt((x2 - x1) ** 2 + (y2 - y1) ** 2)
+    keep = (lengths > min_length) & (y2 != y1)
+    x1, y1, x2, y2, lengths = x1[keep], y1[keep], x2[keep], y2[keep], lengths[keep]
+    # Get the 4 desired features from each line
+    gradients = (x2 - x1) / (y2 - y1)
+    x0s = np.trunc(x1 - gradients * y1)
+    bottom_xs = np.where(y1 > y2, x1, x2)
+    bottom_ys = np.maximum(y1, y2)
+    return np.stack([gradients, x0s, bottom_xs, bottom_ys, lengths], axis=1).astype(np.float64)
+
+def cluster_line_features(lines_features):
+    """Takes an array of line features (see get_line_features) and merges the lines which are the same line.
+    - returns an array of the merged lines (same columns), sorted by x0
+    - lines are sorted by x0, and any adjacent lines with x0 within 5 pixels are the same line
+    - a cluster of lines is merged by averaging adjacent lines again and again until one is left
+      (gradient, x0 and bottom_x), and the largest bottom_y and length are kept
+    - all the lines merged into one has no sides, so in that case (or if there is only one line) there are none"""
+    # Sort by x0 (stable, so lines with the same x0 stay in order)
+    lines_features = lines_features[np.argsort(lines_features[:, 1], kind='stable')]
+    # Split into clusters wherever there is a gap in x0 of more than 5 pixels
+    clusters = np.split(lines_features, np.flatnonzero(np.diff(lines_features[:, 1]) > 5) + 1)
+    if len(clusters) < 2:
+        return np.empty((0, 5), dtype=np.float64)
+    merged_lines = np.empty((len(clusters), 5), dtype=np.float64)
+    for i, cluster in enumerate(clusters):
+        # Group together by averaging adjacent lines until there is one
+        averaged = cluster[:, :3]
+        while len(averaged) > 1:
+            averaged = (averaged[:-1] + averaged[1:]) / 2
+        merged_lines[i, :3] = averaged[0]
+        merged_lines[i, 3:] = cluster[:, 3:].max(axis=0)
+    return merged_lines
+
+def detect_sides(image, display=False, scale=1, min_line_length=None, fallback=True):
+    """In the image it will predict the pipette position, angle and bottom
+    - scale is how much the image has been resized (e.g. 0.5 if downscaled), so the blur and line detection match
+    - min_line_length is the shortest line which can be a side (a fifth of the image height by default)
+    - if fallback is False, None is returned when the sides can't be found (instead of a made up pipette)"""
     
     # Copy and convert grayscale to RGB
     disp_img = cv2.cvtColor(image.copy(), cv2.COLOR_GRAY2RGB)
@@ -322,7 +622,8 @@ def detect_sides(image, display=False):
     height, width = image.shape
 
     # Blur to remove noise
-    image = cv2.GaussianBlur(image, (17, 17), 0)
+    blur_size = max(3, int(17 * scale) // 2 * 2 + 1)
+    image = cv2.GaussianBlur(image, (blur_size, blur_size), 0)
 
     if display:
         cv2.imshow("Blurred", image)
@@ -351,96 +652,38 @@ def detect_sides(image, display=False):
         cv2.waitKey(0)
 
     # Apply Hough line transformation
-    minLineLength = int(height / 5)
-    maxLineGap = 3
-    hough_lines = cv2.HoughLinesP(image, 1, np.pi/180, 115, minLineLength, maxLineGap)
+    minLineLength = int(height / 5) if min_line_length is None else min_line_length
+    maxLineGap = max(1, int(3 * scale))
+    hough_lines = cv2.HoughLinesP(image, 1, np.pi/180, max(1, int(115 * scale)), minLineLength, maxLineGap)
 
-    # Discard all lines too short
     # And return None if no lines
     if hough_lines is None:
-        return 0, 0, 0, 0
-    else:
-        lines = []
-        for line in hough_lines:
-            x1, y1, x2, y2 = line[0]
-            length = np.sqrt((x2 - x1) ** 2 + (y2 - y1) ** 2)
-            if length > minLineLength:
-                lines.append((x1, y1, x2, y2))
-    if lines is None:
-        return 0, 0, 0, 0
+        return (0, 0, 0, 0) if fallback else None
+
+    # Extract useful features from each line (discarding all lines too short)
+    lines_features = get_line_features(hough_lines, minLineLength)
 
     if display:
-        for x1, y1, x2, y2 in lines:
+        for x1, y1, x2, y2 in hough_lines.reshape(-1, 4):
             cv2.line(disp_img,(x1,y1),(x2,y2),(0,0,255),1)
         cv2.imshow("Hough lines", disp_img)
         cv2.waitKey(0)
 
-    # Extract useful features from each line
-    lines_features = []
-    for x1, y1, x2, y2 in lines:
-        # Get the 4 desired features from this line
-        if y2 == y1:
-            continue  # skip horizontal lines — not pipette sides and cause divide-by-zero
-        gradient = (x2 - x1) / (y2 - y1)
-        x0 = int(x1 - gradient * y1)
-        bottom_x = x1 if y1 > y2 else x2
-        bottom_y = max(int(y1), int(y2))
-        length = np.sqrt((x2 - x1) ** 2 + (y2 - y1) ** 2)
-        # Add the line to the list of line features
-        lines_features.append((gradient, x0, bottom_x, bottom_y, length))
-        
     # Cluster based on x0 (ideal results in 4 vertical lines - all on pipette)
-    new_list = []
-    done = False
-    # Sort by x0
-    lines_features.sort(key=lambda x: x[1])
-    # While we are still making changes
-    while not done:
-        done = True
-        last_pair_was_diff = False
-        # For each adjacent pair of lines
-        for i in range(len(lines_features) - 1):
-            # Get the two lines
-            line_1_gradient, line_1_x0, line_1_bottom_x, line_1_bottom_y, line_1_length = lines_features[i]
-            line_2_gradient, line_2_x0, line_2_bottom_x, line_2_bottom_y, line_2_length = lines_features[i + 1]
-            # If they are the same line
-            if abs(line_2_x0 - line_1_x0) <= 5:
-                if last_pair_was_diff:
-                    # Remove the last entry to new_list!
-                    new_list.pop()
-                # Group together by appending the best version of the line to the new list
-                line_3_gradient = (line_1_gradient + line_2_gradient) / 2
-                line_3_x0 = (line_1_x0 + line_2_x0) / 2
-                line_3_bottom_x = (line_1_bottom_x + line_2_bottom_x) / 2
-                line_3_bottom_y = max(line_1_bottom_y, line_2_bottom_y)
-                line_3_length = max(line_1_length, line_2_length)
-                new_list.append((line_3_gradient, line_3_x0, line_3_bottom_x, line_3_bottom_y, line_3_length))
-                done = False
-                last_pair_was_diff = False
-            # If they are different lines
-            else:
-                # If this is iteration 1 add line 1
-                if i == 0:
-                    line_1 = (line_1_gradient, line_1_x0, line_1_bottom_x, line_1_bottom_y, line_1_length)
-                    new_list.append(line_1)
-                # Add line_2
-                line_2 = (line_2_gradient, line_2_x0, line_2_bottom_x, line_2_bottom_y, line_2_length)
-                new_list.append(line_2)
-                last_pair_was_diff = True
-        lines_features = new_list[:]
-        new_list = []
+    lines_features = cluster_line_features(lines_features)
 
     # In some cases the process fails
-    if not lines_features:
+    # (no lines, or all of them are the same line - so there aren't two sides)
+    if len(lines_features) < 2:
+        if not fallback:
+            return None
         default_angle = 0
         default_left_bottom = int(width / 2 - width * 0.1)
         default_right_bottom = int(width / 2 + width * 0.1)
         default_bottom_y = int(height * 0.6)
         return default_angle, default_left_bottom, default_right_bottom, default_bottom_y
 
-    # Sort by x0
-    lines_features.sort(key=lambda x: x[1])
-    # Select the lines on the left and the right sides
+    # Select the lines on the left and the right sides (they are sorted by x0)
     line_1, line_2 = lines_features[0], lines_features[-1]
     # Get the pipette angle (gradient) by averaging both lines
     pipette_angle = (line_1[0] + line_2[0]) / 2
@@ -451,8 +694,40 @@ def detect_sides(image, display=False):
     bottom_y = int((line_1[3] + line_2[3]) / 2)
     return pipette_angle, left_bottom_x, right_bottom_x, bottom_y
 
-def detect_particle(image, left_bottom_x, right_bottom_x, bottom_y, display=False):
-    """In the image using the pipette position predict the particle position and size"""
+def detect_sides_coarse_to_fine(image, display=False):
+    """Does the same as detect_sides, but faster for large images.
+    - first the pipette is found in a downscaled copy of the image (at most COARSE_DETECTION_SIZE pixels each way)
+    - then it is found again at full resolution, in just the region around it
+    - returns None if the image is smaller than COARSE_TO_FINE_MIN_SIZE or the pipette isn't found (so detect_sides should be used)"""
+    height, width = image.shape
+    if max(height, width) < COARSE_TO_FINE_MIN_SIZE:
+        return None
+    scale = COARSE_DETECTION_SIZE / max(height, width)
+    # Find the pipette in the downscaled image
+    coarse_image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    coarse_sides = detect_sides(coarse_image, display=display, scale=scale, fallback=False)
+    if coarse_sides is None:
+        return None
+    pipette_angle, left_bottom_x, right_bottom_x, bottom_y = coarse_sides
+    left_bottom_x, right_bottom_x, bottom_y = left_bottom_x / scale, right_bottom_x / scale, bottom_y / scale
+    # The region of the pipette (where its sides are at the bottom and at the top of the image), plus a margin
+    margin = max(COARSE_ROI_MARGIN, (right_bottom_x - left_bottom_x) / 2)
+    side_xs = [left_bottom_x, right_bottom_x, left_bottom_x - pipette_angle * bottom_y, right_bottom_x - pipette_angle * bottom_y]
+    roi_x = max(0, int(min(side_xs) - margin))
+    roi_x2 = min(width, int(max(side_xs) + margin) + 1)
+    roi_y2 = min(height, int(bottom_y + margin) + 1)
+    if roi_x2 - roi_x < 2 or roi_y2 < 2:
+        return None
+    # Find it again at full resolution (with the same minimum line length as the whole image)
+    fine_sides = detect_sides(image[:roi_y2, roi_x:roi_x2], display=display, min_line_length=int(height / 5), fallback=False)
+    if fine_sides is None:
+        return None
+    pipette_angle, left_bottom_x, right_bottom_x, bottom_y = fine_sides
+    return pipette_angle, left_bottom_x + roi_x, right_bottom_x + roi_x, bottom_y
+
+def detect_particle(image, left_bottom_x, right_bottom_x, bottom_y, display=False, fallback=True):
+    """In the image using the pipette position predict the particle position and size
+    - if fallback is False, None is returned when no circle is found (instead of the expected particle)"""
     # Estimated size and pos
     expected_particle_radius = int((right_bottom_x - left_bottom_x) / 3)
     expected_particle_pos = (int((left_bottom_x + right_bottom_x) / 2), int(bottom_y + expected_particle_radius / 2))
@@ -475,23 +750,106 @@ def detect_particle(image, left_bottom_x, right_bottom_x, bottom_y, display=Fals
         cv2.waitKey(0)
 
     # Perform iterative hough circle
-    x, y, r = bounded_hough_circle(image, bbox, min_r, max_r, expected_particle_radius, display=display)
+    circle = bounded_hough_circle(image, bbox, min_r, max_r, expected_particle_radius, display=display, fallback=fallback)
+    if circle is None:
+        return None
+    x, y, r = circle
     return (x, y), r
 
-def detect_start(image, display=False):
-    """Detects the start state of the pipette and particle in the image"""
+def detect_particle_coarse_to_fine(image, left_bottom_x, right_bottom_x, bottom_y, display=False):
+    """Does the same as detect_particle, but faster for large images.
+    - first the particle is found in a downscaled copy of the image (at most COARSE_DETECTION_SIZE pixels each way)
+    - then it is found again at full resolution, only around where it was found (a few pixels either way)
+    - returns None if the image is smaller than COARSE_TO_FINE_MIN_SIZE or no circle is found (so detect_particle should be used)"""
+    height, width = image.shape
+    if max(height, width) < COARSE_TO_FINE_MIN_SIZE:
+        return None
+    scale = COARSE_DETECTION_SIZE / max(height, width)
+    # Find the particle in the downscaled image
+    coarse_image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    coarse_particle = detect_particle(coarse_image, left_bottom_x * scale, right_bottom_x * scale, bottom_y * scale, 
+                                      display=display, fallback=False)
+    if coarse_particle is None:
+        return None
+    (x, y), r = coarse_particle
+    x, y, r = x / scale, y / scale, r / scale
+    # Find it again at full resolution (allowing for a couple of downscaled pixels of error)
+    error = 2 / scale
+    min_r = max(1, int(r - error))
+    max_r = int(r + error) + 1
+    bbox = [int(x - max_r - error), int(y - max_r - error), int(x + max_r + error), int(y + max_r + error)]
+    circle = bounded_hough_circle(image, bbox, min_r, max_r, int(r), display=display, fallback=False)
+    # If it isn't found again, the downscaled one will do
+    if circle is None:
+        return (int(x), int(y)), int(r)
+    x, y, r = circle
+    return (x, y), r
+
+def detect_pipette(image, display=False, coarse_to_fine=False):
+    """Detects the pipette (and the contrast to see it with) in the image, which is the same for every event of an experiment
+    - if coarse_to_fine is True, images of at least COARSE_TO_FINE_MIN_SIZE pixels are searched with detect_sides_coarse_to_fine (much faster)
+    - returns a dictionary of 'alpha', 'beta' (see calculate_alpha_beta), 'pipette_angle', 'left_bottom_x', 'right_bottom_x', 
+      'bottom_y' (see detect_sides) and 'reference' (see pipette_reference, to check if it moved)"""
     # Auto adjust contrast and brightness
     alpha, beta = calculate_alpha_beta(image)
-    image = cv2.convertScaleAbs(image, alpha=alpha, beta=beta)
-    image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    grey_image = cv2.cvtColor(cv2.convertScaleAbs(image, alpha=alpha, beta=beta), cv2.COLOR_BGR2GRAY)
 
     if display:
-        cv2.imshow("Start frame", image)
+        cv2.imshow("Start frame", grey_image)
         cv2.waitKey(0)
 
     # Detect the pipette position, angle and bottom
-    pipette_angle, left_bottom_x, right_bottom_x, bottom_y = detect_sides(image, display=display)
+    sides = detect_sides_coarse_to_fine(grey_image, display=display) if coarse_to_fine else None
+    if sides is None:
+        sides = detect_sides(grey_image, display=display)
+    pipette_angle, left_bottom_x, right_bottom_x, bottom_y = sides
+    return {
+        'alpha' : alpha,
+        'beta' : beta,
+        'pipette_angle' : pipette_angle,
+        'left_bottom_x' : left_bottom_x,
+        'right_bottom_x' : right_bottom_x,
+        'bottom_y' : bottom_y,
+        'reference' : pipette_reference(image, left_bottom_x, right_bottom_x, bottom_y),
+    }
+
+def pipette_reference(image, left_bottom_x, right_bottom_x, bottom_y):
+    """Returns a small greyscale copy of the part of the image above the particle (the pipette)
+    - used to cheaply check if the pipette has moved (or the lighting changed) between frames
+    - returns None if there is no such part (e.g. the pipette wasn't found)"""
+    # Stop above where the particle can be (see detect_particle)
+    top_of_particle = int(bottom_y - (right_bottom_x - left_bottom_x) / 3)
+    if top_of_particle < PIPETTE_REFERENCE_SIZE:
+        return None
+    grey_image = cv2.cvtColor(image[:top_of_particle], cv2.COLOR_BGR2GRAY)
+    return cv2.resize(grey_image, (PIPETTE_REFERENCE_SIZE, PIPETTE_REFERENCE_SIZE), interpolation=cv2.INTER_AREA).astype(np.float32)
+
+def pipette_moved(pipette, image):
+    """Takes a pipette (from detect_pipette) and an image. Returns True if the pipette 
+    doesn't look the same in the image (so it needs to be detected again)."""
+    if pipette['reference'] is None:
+        return True
+    reference = pipette_reference(image, pipette['left_bottom_x'], pipette['right_bottom_x'], pipette['bottom_y'])
+    if reference is None:
+        return True
+    # Mean difference in brightness
+    return np.mean(np.abs(reference - pipette['reference'])) > PIPETTE_MOVED_THRESHOLD
+
+def detect_start(image, display=False, pipette=None, coarse_to_fine=False):
+    """Detects the start state of the pipette and particle in the image
+    - pipette can be given (see detect_pipette) if already known, e.g. from another frame of the experiment
+    - if coarse_to_fine is True, images of at least COARSE_TO_FINE_MIN_SIZE pixels are first searched downscaled, then only around what was found (much faster)"""
+    # Detect the pipette (if not given)
+    if pipette is None:
+        pipette = detect_pipette(image, display=display, coarse_to_fine=coarse_to_fine)
+    pipette_angle, left_bottom_x, right_bottom_x, bottom_y = pipette['pipette_angle'], pipette['left_bottom_x'], pipette['right_bottom_x'], pipette['bottom_y']
+    # Adjust contrast and brightness
+    image = cv2.convertScaleAbs(image, alpha=pipette['alpha'], beta=pipette['beta'])
+    image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
     # Detect the particle position and size
-    particle_pos, particle_radius = detect_particle(image, left_bottom_x, right_bottom_x, bottom_y, display=display)
+    particle = detect_particle_coarse_to_fine(image, left_bottom_x, right_bottom_x, bottom_y, display=display) if coarse_to_fine else None
+    if particle is None:
+        particle = detect_particle(image, left_bottom_x, right_bottom_x, bottom_y, display=display)
+    particle_pos, particle_radius = particle
     # Return all that
     return particle_pos, particle_radius, pipette_angle, left_bottom_x, right_bottom_x